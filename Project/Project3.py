@@ -1,6 +1,10 @@
 import heapq
+import math
 import numpy as np
 import matplotlib.pyplot as plt
+import scipy.ndimage as ndi
+import scipy.sparse
+from scipy.sparse.csgraph import dijkstra
 
 
 class lwedge:
@@ -12,6 +16,156 @@ class lwedge:
         self.cost = cost
 
 
+class lwGraph:
+    """
+    Directed graph in CSR form: the edges leaving node n go to
+    indices[indptr[n]:indptr[n+1]] with costs weights[indptr[n]:indptr[n+1]].
+    """
+
+    def __init__(self, indptr, indices, weights, shape=None):
+        """
+        Initialize the graph from its CSR arrays.
+        shape is the (r, c) image shape of a pixel graph with nodes x + y*r;
+        it is needed by searches that use pixel coordinates (A*).
+        """
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.N = len(self.indptr) - 1
+        self.indices = np.asarray(indices, dtype=np.int32 if self.N < 2**31 else np.int64)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.shape = shape
+        self.csr = None
+        self.transposed = None
+        self.unit_cost = None
+
+    @classmethod
+    def from_edges(cls, edges, shape=None):
+        """Convert a list of lwedge lists (edges[n] leaving node n) to CSR arrays."""
+        counts = np.fromiter((len(e) for e in edges), dtype=np.int64, count=len(edges))
+        indptr = np.zeros(len(edges) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(counts)
+        indices = np.fromiter((e.child for nd in edges for e in nd), dtype=np.int64, count=indptr[-1])
+        weights = np.fromiter((e.cost for nd in edges for e in nd), dtype=np.float64, count=indptr[-1])
+        return cls(indptr, indices, weights, shape)
+
+    def matrix(self):
+        """Return the graph as a scipy sparse matrix (built once)."""
+        if self.csr is None:
+            self.csr = scipy.sparse.csr_matrix((self.weights, self.indices, self.indptr), shape=(self.N, self.N))
+        return self.csr
+
+    def reverse(self):
+        """Return the graph with all edges reversed (built once)."""
+        if self.transposed is None:
+            rev = self.matrix().T.tocsr()
+            self.transposed = lwGraph(rev.indptr, rev.indices, rev.data, self.shape)
+        return self.transposed
+
+    def min_unit_cost(self):
+        """Return the minimum edge cost per unit of Euclidean pixel distance."""
+        if self.unit_cost is None:
+            if self.shape is None:
+                raise ValueError("The image shape of the graph (lwGraph.shape) is unknown")
+            r = self.shape[0]
+            src = np.repeat(np.arange(self.N), np.diff(self.indptr))
+            length = np.hypot(self.indices % r - src % r, self.indices // r - src // r)
+            moves = length > 0
+            self.unit_cost = float(np.min(self.weights[moves] / length[moves])) if np.any(moves) else 0.0
+        return self.unit_cost
+
+
+class lwCostBuilder:
+    """
+    Builds the 8-connected live-wire graph of an image with the local costs of
+    Mortensen and Barrett: Laplacian zero-crossing fZ, gradient magnitude fG and
+    gradient direction fD. The cost of the link p->q is
+    (wZ*fZ(q) + wG*fG(q) + wD*fD(p,q)) times the link length (sqrt(2) on
+    diagonals), computed for all pixels at once.
+    """
+
+    # neighbour offsets (dx, dy) of the 8-connected graph
+    offsets = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+
+    def __init__(self, wZ=0.43, wG=0.43, wD=0.14, sigma=1.0):
+        """
+        Initialize the cost weights.
+
+        Args:
+            wZ, wG, wD: Weights of the zero-crossing, gradient magnitude and
+                gradient direction costs
+            sigma: Standard deviation of the Gaussian derivative filters
+        """
+        self.wZ = wZ
+        self.wG = wG
+        self.wD = wD
+        self.sigma = sigma
+        self.cache = {}
+
+    def features(self, image):
+        """Return fZ, fG and the unit vectors (Dx, Dy) perpendicular to the gradient."""
+        image = np.asarray(image, dtype=np.float64)
+        Ix = ndi.gaussian_filter(image, self.sigma, order=(1, 0))
+        Iy = ndi.gaussian_filter(image, self.sigma, order=(0, 1))
+        G = np.hypot(Ix, Iy)
+        fG = 1 - G / max(np.max(G), 1e-12)
+
+        # zero crossings: the pixel of a sign change of the Laplacian that is closer to zero
+        lap = ndi.gaussian_laplace(image, self.sigma)
+        fZ = np.ones_like(image)
+        for ax in range(2):
+            lo = [slice(None)] * 2
+            hi = [slice(None)] * 2
+            lo[ax] = slice(0, -1)
+            hi[ax] = slice(1, None)
+            a = lap[tuple(lo)]
+            b = lap[tuple(hi)]
+            cross = a * b < 0
+            fZ[tuple(lo)][cross & (np.abs(a) <= np.abs(b))] = 0
+            fZ[tuple(hi)][cross & (np.abs(b) < np.abs(a))] = 0
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            Dx = np.where(G > 0, Iy / G, 0)
+            Dy = np.where(G > 0, -Ix / G, 0)
+        return fZ, fG, Dx, Dy
+
+    def build(self, image, key=None):
+        """
+        Return the lwGraph of image. If key is given (e.g. the slice index),
+        the graph is cached under it and returned directly on later calls.
+        """
+        if key is not None and key in self.cache:
+            return self.cache[key]
+        r, c = np.shape(image)
+        fZ, fG, Dx, Dy = self.features(image)
+        local = self.wZ * fZ + self.wG * fG
+        x, y = np.meshgrid(np.arange(r), np.arange(c), indexing="ij")
+        src = []
+        dst = []
+        cost = []
+        for dx, dy in self.offsets:
+            ok = (x + dx >= 0) & (x + dx < r) & (y + dy >= 0) & (y + dy < c)
+            px, py = x[ok], y[ok]
+            qx, qy = px + dx, py + dy
+            length = np.hypot(dx, dy)
+
+            # link direction L(p,q) points along D(p)
+            sgn = np.where(Dx[px, py] * dx + Dy[px, py] * dy >= 0, 1, -1) / length
+            dp = np.clip((Dx[px, py] * dx + Dy[px, py] * dy) * sgn, -1, 1)
+            dq = np.clip((Dx[qx, qy] * dx + Dy[qx, qy] * dy) * sgn, -1, 1)
+            fD = 2 / (3 * np.pi) * (np.arccos(dp) + np.arccos(dq))
+
+            src.append(px + py * r)
+            dst.append(qx + qy * r)
+            cost.append(length * (local[qx, qy] + self.wD * fD))
+        src = np.concatenate(src)
+        order = np.argsort(src, kind="stable")
+        indptr = np.zeros(r * c + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(src, minlength=r * c))
+        graph = lwGraph(indptr, np.concatenate(dst)[order], np.concatenate(cost)[order], (r, c))
+        if key is not None:
+            self.cache[key] = graph
+        return graph
+
+
 class graphSearch:
     """Base class for graph search algorithms."""
 
@@ -41,75 +195,290 @@ class graphSearch:
 
 
 class graphSearchLW(graphSearch):
-    """Graph search implementation for lightweight edge representation."""
+    """
+    Dijkstra search on a CSR graph (lwGraph) with costs, parents and visited
+    flags stored in numpy arrays indexed by node. Lists of lwedge lists are
+    accepted too and converted once.
+    """
 
     def __init__(self):
         """Initialize graph search for lightweight edges."""
         super().__init__(node_type=lwedge)
-
-    def run(self, edges, seed, endnode=None):
+        self.graph = None
+        self.source = None
+
+    def graph_of(self, edges):
+        """Return edges as an lwGraph, converting the same lwedge lists only once."""
+        if isinstance(edges, lwGraph):
+            return edges
+        if edges is not self.source:
+            self.source = edges
+            self.graph = lwGraph.from_edges(edges)
+        return self.graph
+
+    def start(self, edges, seed):
         """
-        Run Dijkstra's algorithm from seed to endnode (if specified).
-        Returns path and cost to endnode or to all nodes.
+        Start a resumable Dijkstra search from seed.
+        The shortest-path tree is grown by expand() and queried by query().
         """
-        # Initialize data structures
-        self.parents = {}
-        self.costs = {seed: 0}
-        visited = set()
-        priority_queue = [(0, seed)]
+        self.edges = self.graph_of(edges)
+        self.seed = seed
+        N = self.edges.N
+        self.costs = np.full(N, np.inf)
+        self.costs[seed] = 0
+        self.parents = np.full(N, -1, dtype=np.int64)
+        self.visited = np.zeros(N, dtype=bool)
+        self.priority_queue = [(0.0, seed)]
+        self.expanded = 0
+
+    def expand(self, endnode=None, maxnodes=None):
+        """
+        Continue the search until endnode is settled, maxnodes more nodes are
+        settled or the whole tree is known. Returns True when the tree is complete.
+        """
+        # Memoryviews index the numpy arrays element by element much faster
+        indptr = memoryview(self.edges.indptr)
+        indices = memoryview(self.edges.indices)
+        weights = memoryview(self.edges.weights)
+        costs = memoryview(self.costs)
+        parents = memoryview(self.parents)
+        visited = memoryview(self.visited)
+        queue = self.priority_queue
+        settled = 0
+        while queue:
+            # Stop before settling more nodes than allowed in this call
+            if maxnodes is not None and settled >= maxnodes:
+                return False
 
-        while priority_queue:
             # Get node with lowest cost
-            current_cost, current_node = heapq.heappop(priority_queue)
+            current_cost, current_node = heapq.heappop(queue)
 
             # Skip if we've already processed this node
-            if current_node in visited:
+            if visited[current_node]:
                 continue
 
             # Mark as visited
-            visited.add(current_node)
+            visited[current_node] = True
+            settled += 1
+            self.expanded += 1
+
+            # Explore neighbors
+            for e in range(indptr[current_node], indptr[current_node + 1]):
+                child = indices[e]
+                new_cost = current_cost + weights[e]
+
+                # Update cost if we found a better path
+                if new_cost < costs[child]:
+                    costs[child] = new_cost
+                    parents[child] = current_node
+                    heapq.heappush(queue, (new_cost, child))
 
             # If we reached the target node, we're done
             if endnode is not None and current_node == endnode:
-                break
+                return not queue
 
-            # Explore neighbors
-            for edge in edges[current_node]:
-                child = edge.child
-                new_cost = current_cost + edge.cost
+        return True
 
-                # Update cost if we found a better path
-                if child not in self.costs or new_cost < self.costs[child]:
-                    self.costs[child] = new_cost
-                    self.parents[child] = current_node
-                    heapq.heappush(priority_queue, (new_cost, child))
+    def query(self, endnode):
+        """
+        Return path and cost from the seed of the current search to endnode,
+        expanding the tree only if endnode is not settled yet.
+        """
+        if not self.visited[endnode]:
+            self.expand(endnode)
+        if np.isfinite(self.costs[endnode]):
+            return self.trace(endnode, self.seed), float(self.costs[endnode])
+        return None, float("inf")  # No path found
+
+    def trace(self, nd, seed):
+        """Trace path from end back to seed using the parent array."""
+        path = [nd]
+        while nd != seed:
+            nd = int(self.parents[nd])
+            if nd < 0:
+                return None  # No path exists
+            path.append(nd)
+        return path
+
+    def run(self, edges, seed, endnode=None, method=None):
+        """
+        Run Dijkstra's algorithm from seed to endnode (if specified).
+        Returns path and cost to endnode or to all nodes.
+        method selects the point-to-point search for this call: "dijkstra",
+        "astar" or "bidirectional" (default: the search of this class).
+        """
+        # Point-to-point search of another class on the same converted graph
+        if endnode is not None and method is not None and type(self) is not searchMethods[method]:
+            search = searchMethods[method]()
+            search.source, search.graph = self.source, self.graph
+            result = search.run(edges, seed, endnode)
+            self.expanded = search.expanded
+            return result
 
         # If endnode is specified, return path and cost to it
         if endnode is not None:
-            if endnode in self.costs:
-                path = self.trace(endnode, seed)
-                return path, self.costs[endnode]
-            return None, float("inf")  # No path found
+            self.start(edges, seed)
+            return self.query(endnode)
+
+        # The complete tree is computed by scipy's compiled Dijkstra
+        self.edges = self.graph_of(edges)
+        self.seed = seed
+        self.costs, parents = dijkstra(self.edges.matrix(), indices=seed, return_predecessors=True)
+        self.parents = np.where(parents < 0, -1, parents).astype(np.int64)
+        self.visited = np.isfinite(self.costs)
+        self.priority_queue = []
+        self.expanded = int(np.sum(self.visited))
 
         # Return empty lists if no endnode was specified
         return [], 0
 
 
+class graphSearchAStar(graphSearchLW):
+    """
+    A* point-to-point search. The heuristic is the Euclidean pixel distance to
+    the end node times the minimum edge cost per unit length, which is
+    admissible and consistent, so the path is a shortest path. Only the costs
+    of visited nodes are final afterwards. Searches without an end node run
+    Dijkstra.
+    """
+
+    def run(self, edges, seed, endnode=None, method=None):
+        """Run A* from seed to endnode and return path and cost to endnode."""
+        if endnode is None or method not in (None, "astar"):
+            return super().run(edges, seed, endnode, method)
+        self.start(edges, seed)
+        graph = self.edges
+        scale = graph.min_unit_cost()
+        r = graph.shape[0]
+        ex, ey = endnode % r, endnode // r
+
+        indptr = memoryview(graph.indptr)
+        indices = memoryview(graph.indices)
+        weights = memoryview(graph.weights)
+        costs = memoryview(self.costs)
+        parents = memoryview(self.parents)
+        visited = memoryview(self.visited)
+        queue = [(scale * math.hypot(seed % r - ex, seed // r - ey), seed)]
+        while queue:
+            _, current_node = heapq.heappop(queue)
+            if visited[current_node]:
+                continue
+            visited[current_node] = True
+            self.expanded += 1
+            if current_node == endnode:
+                break
+            current_cost = costs[current_node]
+            for e in range(indptr[current_node], indptr[current_node + 1]):
+                child = indices[e]
+                new_cost = current_cost + weights[e]
+                if new_cost < costs[child]:
+                    costs[child] = new_cost
+                    parents[child] = current_node
+                    heapq.heappush(queue, (new_cost + scale * math.hypot(child % r - ex, child // r - ey), child))
+        self.priority_queue = []
+
+        if self.visited[endnode]:
+            return self.trace(endnode, seed), float(self.costs[endnode])
+        return None, float("inf")  # No path found
+
+
+class graphSearchBidirectional(graphSearchLW):
+    """
+    Bidirectional Dijkstra point-to-point search: one search from the seed on
+    the graph and one from the end node on the reversed graph, stopped when
+    the sum of their smallest queued costs reaches the best meeting cost.
+    Searches without an end node run Dijkstra.
+    """
+
+    def run(self, edges, seed, endnode=None, method=None):
+        """Run bidirectional Dijkstra from seed to endnode and return path and cost to endnode."""
+        if endnode is None or method not in (None, "bidirectional"):
+            return super().run(edges, seed, endnode, method)
+        self.start(edges, seed)
+        graph = self.edges
+        N = graph.N
+        self.costs_back = np.full(N, np.inf)
+        self.costs_back[endnode] = 0
+        self.parents_back = np.full(N, -1, dtype=np.int64)
+        self.visited_back = np.zeros(N, dtype=bool)
+
+        # forward and backward side: graph, costs, parents, visited, queue
+        sides = []
+        for g, costs, parents, visited, start in (
+            (graph, self.costs, self.parents, self.visited, seed),
+            (graph.reverse(), self.costs_back, self.parents_back, self.visited_back, endnode),
+        ):
+            sides.append((memoryview(g.indptr), memoryview(g.indices), memoryview(g.weights),
+                          memoryview(costs), memoryview(parents), memoryview(visited), [(0.0, start)]))
+        best = 0.0 if seed == endnode else math.inf
+        meet = seed if seed == endnode else -1
+        forward_queue = sides[0][6]
+        backward_queue = sides[1][6]
+        while forward_queue and backward_queue:
+            if forward_queue[0][0] + backward_queue[0][0] >= best:
+                break
+            # Expand the side with the smaller queued cost
+            side = 0 if forward_queue[0][0] <= backward_queue[0][0] else 1
+            indptr, indices, weights, costs, parents, visited, queue = sides[side]
+            other_costs = sides[1 - side][3]
+            current_cost, current_node = heapq.heappop(queue)
+            if visited[current_node]:
+                continue
+            visited[current_node] = True
+            self.expanded += 1
+            for e in range(indptr[current_node], indptr[current_node + 1]):
+                child = indices[e]
+                new_cost = current_cost + weights[e]
+                if new_cost < costs[child]:
+                    costs[child] = new_cost
+                    parents[child] = current_node
+                    heapq.heappush(queue, (new_cost, child))
+                # Best path through this edge so far
+                if new_cost + other_costs[child] < best:
+                    best = new_cost + other_costs[child]
+                    meet = child
+        self.priority_queue = []
+
+        if meet < 0:
+            return None, float("inf")  # No path found
+        # end ... meet from the backward tree, then meet ... seed from the forward tree
+        back = [meet]
+        while back[-1] != endnode:
+            back.append(int(self.parents_back[back[-1]]))
+        return back[::-1] + self.trace(meet, seed)[1:], float(best)
+
+
+# point-to-point searches selectable by graphSearchLW.run(..., method=...)
+searchMethods = {"dijkstra": graphSearchLW, "astar": graphSearchAStar, "bidirectional": graphSearchBidirectional}
+
+
 class liveWire:
     """Interactive contour drawing class using graphSearch."""
 
-    def __init__(self, image, edges=None):
+    def __init__(self, image, edges=None, chunk=None):
         """
         Initialize liveWire with image and edge weights.
 
         Args:
             image: 2D numpy array representing the image
-            edges: List of edge lists for graph search
+            edges: List of lwedge lists or lwGraph for graph search. If None,
+                the graph is built from the image by lwCostBuilder
+            chunk: Nodes settled per timer tick while the shortest-path tree
+                from the current anchor is grown in the background. If None,
+                the complete tree is computed when the anchor is placed
         """
         self.image = image
         self.edges = edges
         self.r, self.c = np.shape(image)
         self.gs = graphSearchLW()
+        self.chunk = chunk
+        # Convert the edge lists once
+        if edges is None:
+            self.graph = lwCostBuilder().build(image)
+        else:
+            self.graph = self.gs.graph_of(edges)
+        if self.graph.shape is None:
+            self.graph.shape = (self.r, self.c)
 
         # Initialize variables for tracking contour
         self.seed = None
@@ -126,6 +495,10 @@ class liveWire:
         (self.contour_line,) = self.ax.plot([], [], "r-")
         (self.points_line,) = self.ax.plot([], [], "go")
 
+        # Timer that grows the shortest-path tree between mouse events
+        self.timer = self.fig.canvas.new_timer(interval=1)
+        self.timer.add_callback(self.grow)
+
         # Connect event handlers
         self.fig.canvas.mpl_connect("button_press_event", self.onclick)
         self.fig.canvas.mpl_connect("motion_notify_event", self.onmove)
@@ -133,6 +506,20 @@ class liveWire:
         plt.title("Left click to add points, right click to complete")
         plt.show()
 
+    def set_anchor(self, node):
+        """Compute the shortest-path tree from a new anchor or start growing it in the background."""
+        self.last_point = node
+        if self.chunk is None:
+            self.gs.run(self.graph, node)
+        else:
+            self.gs.start(self.graph, node)
+            self.timer.start()
+
+    def grow(self):
+        """Timer callback: settle another chunk of the tree until it is complete."""
+        if self.gs.expand(maxnodes=self.chunk):
+            self.timer.stop()
+
     def onclick(self, event):
         """Handle mouse click events."""
         if event.inaxes != self.ax:
@@ -152,14 +539,14 @@ class liveWire:
             if not self.active:
                 # First click - initialize contour
                 self.seed = node
-                self.last_point = node
+                self.set_anchor(node)
                 self.cntrpts.clear()
                 self.cntrcur.clear()
                 self.cntrpts.append((x, y))
                 self.active = True
             else:
                 # Add point and segment to contour
-                path, cost = self.gs.run(self.edges, self.last_point, node)
+                path, cost = self.gs.query(node)
                 self.cntcst += cost
                 if path:
                     # Reverse the path so it goes from start to end
@@ -167,7 +554,7 @@ class liveWire:
                     # Convert path nodes to 2D coordinates
                     path_coords = np.array([(n % self.r, n // self.r) for n in path])
                     self.cntrcur.append(path_coords)
-                    self.last_point = node
+                    self.set_anchor(node)
                     self.cntrpts.append((x, y))
                     self.update_display()
 
@@ -175,7 +562,7 @@ class liveWire:
         elif event.button == 3 and self.active:
             # Close the contour by connecting back to the first point
             if self.seed != self.last_point:
-                path, cost = self.gs.run(self.edges, self.last_point, self.seed)
+                path, cost = self.gs.query(self.seed)
                 self.cntcst += cost
                 if path:
                     path.reverse()  # Reverse the path
@@ -183,6 +570,7 @@ class liveWire:
                     self.cntrcur.append(path_coords)
                     self.update_display()
 
+            self.timer.stop()
             self.active = False
             self.complete = True
             print(f"Contour completed. Cost: {self.cntcst:.3f}")
@@ -199,9 +587,10 @@ class liveWire:
         if x < 0 or x >= self.r or y < 0 or y >= self.c:
             return
 
-        # Calculate potential path to current mouse position
+        # Trace the potential path to the current mouse position in the tree
+        # from the anchor (only the missing part of the tree is searched)
         node = x + y * self.r
-        path, _ = self.gs.run(self.edges, self.last_point, node)
+        path, _ = self.gs.query(node)
 
         if path:
             # Reverse the path
@@ -0,0 +1,139 @@
+# % Correctness and throughput benchmark for the graphCutBasic max-flow engines
+# % ECE 8396: Medical Image Segmentation
+# % Spring 2025
+
+import sys
+import json
+import time
+import tracemalloc
+import numpy as np
+import networkx as nx
+from GraphCutBasic import *
+from testGraphCut import graphCutPhantom
+
+# engine/layout combinations passed to graphCutBasic.segment
+ENGINES = [('bk', False), ('bk', True), ('pushrelabel', False), ('pushrelabel', True)]
+
+def randomGridGraph(shape, seed=0, density=0.3):
+    # 6-connected grid with random n-link capacities and sparse random t-links, as nlink lists and tlinks
+    rng = np.random.default_rng(seed)
+    r, c, d = shape
+    N = r*c*d
+    g = graphCutBasic()
+    g.N = N
+    g.initEdges(np.zeros(shape), np.full(N, 0.5))
+    g.cap[:] = rng.random(len(g.cap))
+    tlinks = rng.random((N, 2))*(rng.random((N, 2)) < density)
+    return g.getNlinks(), tlinks
+
+def cutValue(nlinks, tlinks, msk):
+    # capacity of the cut with the voxels in msk on the source side
+    cut = np.sum(tlinks[~msk, 0]) + np.sum(tlinks[msk, 1])
+    for i in np.nonzero(msk)[0]:
+        cut += sum(nn.cap for nn in nlinks[i] if not msk[nn.neib])
+    return cut
+
+def nxCut(nlinks, tlinks):
+    # networkx max-flow value and the source side of the minimum cut (voxels reachable from s in the residual)
+    G = nx.DiGraph()
+    N = len(nlinks)
+    for i in range(N):
+        G.add_edge('s', i, capacity=float(tlinks[i, 0]))
+        G.add_edge(i, 't', capacity=float(tlinks[i, 1]))
+        for nn in nlinks[i]:
+            G.add_edge(i, nn.neib, capacity=float(nn.cap))
+    value, (S, T) = nx.minimum_cut(G, 's', 't')
+    msk = np.zeros(N, dtype=bool)
+    msk[[n for n in S if n != 's']] = True
+    return value, msk
+
+def checkCorrectness(shapes=((3, 3, 2), (4, 5, 3), (6, 6, 4), (10, 10, 3), (12, 12, 4)), seeds=range(5), tol=1e-6):
+    # flow value and cut value of every engine against the networkx flow value on small random grids, and on
+    # phantoms for shapes large enough to hold separate source and sink seed blocks. networkx finds its partition
+    # with a float tolerance, so it can be a slightly worse cut than its own flow; masks are only compared when the
+    # capacity of the networkx partition equals its flow
+    failures = []
+    ncases = 0
+    nmasks = 0
+    for shape in shapes:
+        for seed in seeds:
+            cases = [('random', *randomGridGraph(shape, seed))]
+            if min(shape[0:2]) >= 10:
+                cases.append(('phantom', *graphCutPhantom(*shape, seed=seed)))
+            for case in cases:
+                if case[0] == 'random':
+                    nlinks, tlinks = case[1], case[2]
+                    ref, refmsk = nxCut(nlinks, tlinks)
+                else:
+                    # cut the phantom once to get its graph, then compare every engine with networkx on it
+                    g = graphCutBasic()
+                    g.segment(case[1], source=case[2], sink=case[3])
+                    tlinks = g.tcap.copy()
+                    gg = graphCutBasic()
+                    gg.N = np.prod(shape)
+                    gg.initEdges(case[1], np.full(gg.N, 0.5))
+                    nlinks = gg.getNlinks()
+                    ref, refmsk = nxCut(nlinks, tlinks)
+                refcut = cutValue(nlinks, tlinks, refmsk)
+                for engine, grid in ENGINES:
+                    if grid and case[0] == 'random':
+                        # random capacities are only available as nlink lists
+                        continue
+                    g = graphCutBasic()
+                    if case[0] == 'random':
+                        msk = g.segment(np.zeros(shape), nlinks=nlinks, tlinks=tlinks.copy(), engine=engine)
+                    else:
+                        msk = g.segment(case[1], source=case[2], sink=case[3], engine=engine, grid=grid)
+                    msk = np.ravel(msk, order='F')
+                    ncases += 1
+                    # grid mode stores float32 capacities
+                    rtol = 1e-5 if grid else tol
+                    cut = cutValue(nlinks, tlinks, msk)
+                    exact = abs(refcut - ref) <= rtol*max(1., ref)
+                    nmasks += exact
+                    if (abs(g.totcap - ref) > rtol*max(1., ref) or abs(cut - ref) > rtol*max(1., ref) or
+                            (exact and not np.array_equal(msk, refmsk))):
+                        failures.append({'case': case[0], 'shape': shape, 'seed': seed, 'engine': engine,
+                                         'grid': grid, 'flow': float(g.totcap), 'cut': float(cut),
+                                         'reference': float(ref), 'referencecut': float(refcut),
+                                         'maskdiff': int(np.sum(msk != refmsk)) if exact else None})
+    print(f'{ncases} cuts checked against networkx ({nmasks} with masks), {len(failures)} failures')
+    for f in failures:
+        print('  ', f)
+    return failures
+
+def benchmark(shapes=((32, 32, 8), (64, 64, 16)), fname='graphcut_benchmark.json', memory=True):
+    # throughput and peak memory of every engine on noisy phantoms, written to fname for regression tracking.
+    # Timing runs are untraced; peak memory comes from a second run under tracemalloc, which is much slower
+    results = []
+    for shape in shapes:
+        img, source, sink = graphCutPhantom(*shape)
+        N = int(np.prod(shape))
+        for engine, grid in ENGINES:
+            g = graphCutBasic()
+            t = time.time()
+            g.segment(img, source=source, sink=sink, engine=engine, grid=grid)
+            elapsed = time.time() - t
+            # augmenting paths for BK, pushes for push-relabel
+            ops = g.iter if engine == 'bk' else g.pushes
+            res = {'shape': list(shape), 'voxels': N, 'engine': engine, 'grid': grid, 'time': elapsed,
+                   'flow': float(g.totcap), 'voxels_per_s': N/elapsed,
+                   ('augmentations_per_s' if engine == 'bk' else 'pushes_per_s'): ops/elapsed}
+            if memory:
+                tracemalloc.start()
+                graphCutBasic().segment(img, source=source, sink=sink, engine=engine, grid=grid)
+                current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                res['peak_mb'] = peak/2**20
+                res['peak_bytes_per_voxel'] = peak/N
+            print(f'{shape} {engine:12s} grid={grid!s:5s} {elapsed:8.3f} s {N/elapsed:10.0f} vox/s '
+                  f'{ops/elapsed:10.0f} ops/s' + (f' peak {res["peak_mb"]:8.1f} MB' if memory else ''))
+            results.append(res)
+    with open(fname, 'w') as f:
+        json.dump(results, f, indent=1)
+    return results
+
+if __name__ == "__main__":
+    failures = checkCorrectness()
+    benchmark()
+    sys.exit(1 if failures else 0)
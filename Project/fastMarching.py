@@ -237,6 +237,63 @@ class fastMarching:
                     self.nb.insert(lSNode(x,y,z,ndist))
                     self.active[x,y,z] = 2
 
+    def insertBorderArrays(self, dmap_i, fore=True):
+        # array version of insertBorderVoxels used by updateMulti: the same border voxels and distances,
+        # pushed into the heap in the same order, without a python loop over the estimates
+        r,c,d = np.shape(dmap_i)
+        direction = 1 if fore else -1
+        nbo = list(self.nbin) + list(self.nbout)
+        if len(nbo)==0:
+            msk = np.zeros((r,c,d), dtype=bool)
+            mskx = dmap_i[0:r-1,:,:] * dmap_i[1:,:,:]<=0
+            msky = dmap_i[:,0:c-1,:] * dmap_i[:,1:,:]<=0
+            mskz = dmap_i[:,:,0:d-1] * dmap_i[:,:,1:]<=0
+            msk[0:-1,:,:] |= mskx
+            msk[1:,:,:] |= mskx
+            msk[:,0:-1,:] |= msky
+            msk[:,1:,:] |= msky
+            msk[:,:,0:-1] |= mskz
+            msk[:,:,1:] |= mskz
+            X, Y, Z = np.nonzero(msk)
+        else:
+            X = np.array([nd.x for nd in nbo], dtype=int)
+            Y = np.array([nd.y for nd in nbo], dtype=int)
+            Z = np.array([nd.z for nd in nbo], dtype=int)
+        keep = dmap_i[X,Y,Z]*direction <= 0
+        X, Y, Z = X[keep], Y[keep], Z[keep]
+        v = dmap_i[X,Y,Z]
+
+        weight = np.zeros(len(v))
+        cnt = np.zeros(len(v), dtype=int)
+        zero = np.zeros(len(v), dtype=bool)
+        for j, n in enumerate((r, c, d)):
+            # neighbours across the volume border take the voxel's own value, as in insertBorderVoxels
+            plus = [X, Y, Z]
+            minus = [X, Y, Z]
+            plus[j] = np.minimum(plus[j]+1, n-1)
+            minus[j] = np.maximum(minus[j]-1, 0)
+            d1, d2 = [self.oneSided(v, dmap_i[tuple(nbr)], direction, self.voxsz[j]) for nbr in (plus, minus)]
+            ndist = np.where(d1 < d2, d1, d2)
+            zero |= ndist == 0
+            near = (ndist < 2*self.voxsz[j]) & (ndist != 0)
+            cnt += near
+            weight[near] += 1/(ndist[near]*ndist[near])
+        dist = np.zeros(len(v))
+        far = ~zero & (cnt>0)
+        dist[far] = 1/np.sqrt(weight[far])/self.speed[X[far],Y[far],Z[far]]
+
+        ins = zero | (cnt>0)
+        for x, y, z, nd in zip(X[ins], Y[ins], Z[ins], dist[ins]):
+            self.dmap[x,y,z] = nd
+            self.nb.insert(lSNode(x,y,z,nd))
+            self.active[x,y,z] = 2
+
+    def oneSided(self, v, nbr, direction, h):
+        # distance estimates to the zero crossing towards neighbours on the other side, 2*h where there is none
+        denom = v - nbr
+        denom[denom==0] = 1
+        return np.where(nbr*direction >= 0, v * h / denom, 2*h)
+
     def upwindEikonal(self, node):
         """
         Re-estimate distances for 6-connected neighbors of the given node,
@@ -339,4 +396,46 @@ class fastMarching:
                     self.nb.insert(lSNode(nx, ny, nz, new_dist))
                     # Mark as trial node if not already
                     if self.active[nx, ny, nz] != 2:
-                        self.active[nx, ny, nz] = 2
\ No newline at end of file
+                        self.active[nx, ny, nz] = 2
+
+def updateMulti(fms, nbdist=np.inf):
+    # Re-initialize the distance maps of several fastMarching objects in one pass (see levelSet.segmentMulti).
+    # The maps and bands are the same as from calling update() on each one, but the objects share one speed
+    # array, one active array and one copy of the previous map as scratch instead of allocating them per
+    # object, the border voxels are estimated with array operations (insertBorderArrays), and the new bands
+    # are kept as built instead of deep copied
+    if len(fms)==0:
+        return
+    shape = np.shape(fms[0].dmap)
+    speed = np.ones(shape)
+    active = np.zeros(shape, dtype=bool)
+    dmap_i = np.zeros(shape)
+    for fm in fms:
+        np.copyto(dmap_i, fm.dmap)
+        fm.dmap[:] = INF
+        fm.speed = speed
+        fm.active = active
+        bands = []
+        # foreground band first (its distances are made negative once it is finished), then the background
+        for fore in (True, False):
+            if fore:
+                np.less_equal(dmap_i, 0, out=active)
+            else:
+                np.greater_equal(dmap_i, 0, out=active)
+            fm.nb = heap()
+            fm.insertBorderArrays(dmap_i, fore)
+            nbo = []
+            dist = 0
+            while fm.nb.isEmpty()==False and dist < nbdist:
+                nd = fm.nb.pop()
+                while active[nd.x, nd.y, nd.z]==0 and fm.nb.isEmpty()==False:
+                    nd = fm.nb.pop()
+                dist = nd.d
+                nbo.append(nd)
+                active[nd.x, nd.y, nd.z] = 0
+                fm.upwindEikonal(nd)
+            if fore:
+                fm.dmap[dmap_i<=0] *= -1
+            bands.append(nbo)
+        fm.nbin, fm.nbout = bands
+        fm.nb = heap()
\ No newline at end of file
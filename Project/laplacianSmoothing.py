@@ -3,11 +3,101 @@
 # % Spring 2024
 # % Author: Prof. Jack Noble; jack.noble@vanderbilt.edu
 
+import time
+import warnings
 import numpy as np
 from scipy import sparse
+import scipy.sparse.linalg
 
 #node number = x + r*y + r*c*z
-def laplacianSmoothing(r,c,d,dirn,dirv,intn,intv,intw):
+def laplacianSmoothing(r,c,d,dirn,dirv,intn,intv,intw, solver='direct', precond=None, tol=1e-8, maxiter=1000,
+                       x0=None, return_info=False, matrixfree=False):
+    # solver: 'direct' (spsolve on the full system with ghost nodes), 'cg'/'bicgstab' on the reduced
+    #   symmetric system of reducedSystem, or 'multigrid' (V-cycles/FMG of the multigrid class on that system).
+    #   Direct solves of full size CT volumes run out of memory.
+    # precond: None, 'jacobi', 'ilu' or 'multigrid' (one V-cycle) for cg/bicgstab; other names, or any
+    #   preconditioner with direct/multigrid, raise a ValueError. ILU is not symmetric, so it is rejected with cg
+    # matrixfree: cg/bicgstab apply the operator with stencils on the 3D array (laplacianOperator)
+    #   instead of assembling a sparse matrix. Only the 'jacobi' preconditioner is available then; 'direct' and
+    #   'multigrid' need the assembled matrix and raise a ValueError
+    # tol, maxiter: relative residual tolerance and iteration limit of the iterative solvers
+    # x0: previous solution (r x c x d) used as a warm start by the iterative solvers
+    # return_info: also return a dict with the solve time, iteration count, convergence flag and relative
+    #   residual history. The history costs one extra matrix product per iteration, so it is only recorded then
+    t = time.perf_counter()
+    checkOptions(solver, precond, matrixfree)
+    converged = True
+    if solver == 'direct':
+        A, b = laplacianSystem(r,c,d,dirn,dirv,intn,intv,intw)
+        # For large systems, DLL implementation of biconjugate gradient solver is MUCH faster
+        # bc = bicg()
+        # x = bc.Solve(N+M, N+M, I, J, V, b, maxiter=1000)
+        x = sparse.linalg.spsolve(A,b)
+        phi = np.reshape(x[0:r*c*d], [r,c,d], order='F')
+        residuals = [np.linalg.norm(b - A @ x) / max(np.linalg.norm(b), 1e-300)]
+        iterations = 1
+    elif matrixfree:
+        A, b, diag = laplacianOperator(r,c,d,dirn,dirv,intn,intv,intw)
+        if precond == 'jacobi':
+            M = sparse.linalg.LinearOperator(A.shape, matvec=lambda x: x / diag, dtype=np.double)
+        else:
+            M = None
+        # known nodes are identity rows of A, so starting from their values keeps them exact; a warm start
+        # gets them overwritten as well
+        x0 = np.where(diag==1, b, 0 if x0 is None else np.ravel(x0, order='F'))
+        x, info = iterativeSolve(A, b, solver, M, tol, maxiter, x0, return_info)
+        phi = np.reshape(x, [r,c,d], order='F')
+        residuals, iterations, converged = info['residuals'], info['iterations'], info['converged']
+    else:
+        S, b, free, phi = reducedSystem(r,c,d,dirn,dirv,intn,intv,intw)
+        x0 = None if x0 is None else np.ravel(x0, order='F')[free]
+        if solver == 'multigrid':
+            x, residuals = multigrid(S, (r,c,d), free).solve(b, x0, tol, maxiter)
+            iterations = len(residuals)
+            converged = residuals[-1] <= tol
+        else:
+            M = preconditioner(S, precond, (r,c,d), free)
+            x, info = iterativeSolve(S, b, solver, M, tol, maxiter, x0, return_info)
+            residuals, iterations, converged = info['residuals'], info['iterations'], info['converged']
+        phi[free] = x
+        phi = np.reshape(phi, [r,c,d], order='F')
+
+    if return_info:
+        return phi, {'solver': solver, 'precond': precond, 'iterations': iterations, 'converged': converged,
+                     'residuals': residuals, 'time': time.perf_counter() - t}
+    return phi
+
+def checkOptions(solver, precond, matrixfree=False):
+    # reject solver/preconditioner combinations that cannot work
+    if solver not in ('direct', 'cg', 'bicgstab', 'multigrid'):
+        raise ValueError(f'Unknown solver {solver}')
+    if precond not in (None, 'jacobi', 'ilu', 'multigrid'):
+        raise ValueError(f'Unknown preconditioner {precond}')
+    if precond is not None and solver not in ('cg', 'bicgstab'):
+        raise ValueError(f"Preconditioner {precond} needs solver='cg' or 'bicgstab'; solver='{solver}' does not use one")
+    if matrixfree and solver not in ('cg', 'bicgstab'):
+        raise ValueError(f"matrixfree needs solver='cg' or 'bicgstab'; solver='{solver}' needs an assembled matrix")
+    if matrixfree and precond not in (None, 'jacobi'):
+        raise ValueError(f'Preconditioner {precond} needs an assembled matrix')
+    if solver == 'cg' and precond == 'ilu':
+        raise ValueError("The ILU preconditioner is not symmetric, so CG cannot use it; use solver='bicgstab'")
+
+def laplacianSystem(r,c,d,dirn,dirv,intn,intv,intw):
+    # full (N+M)x(N+M) system with M ghost nodes for the Neumann boundaries. Returns A (csc) and b
+    I, J = laplacianStructure(r,c,d)
+    V = laplacianValues(r,c,d,dirn,intn,intw)
+    N = r*c*d
+    M = 2*(r*c + r*d + c*d)
+
+    # can use sparse.linalg.spsolve from scipy.sparse
+    A = sparse.coo_matrix((V, (I,J)), shape=(N+M, N+M)).tocsc()
+    A.eliminate_zeros()
+    return A, laplacianRHS(N+M, dirn, dirv, intn, intv, intw)
+
+def laplacianStructure(r,c,d):
+    # Sparsity pattern of the ghost node system; it depends only on the grid shape. Returns the row and
+    # column indices of the N x 7 Laplacian entries (centre, x-, x+, y-, y+, z-, z+) followed by the
+    # M x 2 ghost node entries. Dirichlet rows keep their 6 off-diagonal slots, with value 0
     X,Y,Z = np.meshgrid(np.arange(0,r), np.arange(0,c), np.arange(0,d), indexing='ij')
     X = X.ravel(order='F').astype(np.longlong)
     Y = Y.ravel(order='F').astype(np.longlong)
@@ -18,13 +108,6 @@ def laplacianSmoothing(r,c,d,dirn,dirv,intn,intv,intw):
     cd = c * d
     N = np.array(rc*d, dtype=np.longlong) # number of nodes
     M = np.array(2*(rc + rd + cd), dtype=np.longlong) # number of 'ghost' nodes
-    D = np.size(dirn) # number of Dirichlet nodes
-    P = 7*(N-D) + D + 2*M # number of nonzero entries in sparse matrix
-
-    I = np.zeros(P, dtype=np.intc)
-    J = np.zeros(P, dtype=np.intc)
-    V = np.zeros(P, dtype=np.double)
-
 
     rows1 = np.repeat(np.arange(0,N)[:,np.newaxis],7,axis=1)
     cols1 = rows1 + np.repeat(np.array([0, -1, 1, -r, r, -rc, rc])[np.newaxis,:], N, axis=0)
@@ -32,8 +115,6 @@ def laplacianSmoothing(r,c,d,dirn,dirv,intn,intv,intw):
 
     rows2 = np.repeat(np.arange(N, N+M)[:,np.newaxis], 2, axis=1)
     cols2 = np.copy(rows2)
-    V2 = np.ones((M,2))
-    V2[:,1] = -1
 
     # Handling Neumann boundaries
     # X==0
@@ -67,40 +148,380 @@ def laplacianSmoothing(r,c,d,dirn,dirv,intn,intv,intw):
     cols1[bndind, 6] = N + 2 * (cd + rd) + rc + X[bndind] + Y[bndind] * r
     cols2[2 * (cd + rd) + rc + X[bndind] + Y[bndind] * r, 1] = bndind
 
-    # For Laplacian, first column of values should be equal to negative sum of all others
-    V1 = np.ones((N, 7))
+    I = np.concatenate((rows1.ravel(), rows2.ravel())).astype(np.intc)
+    J = np.concatenate((cols1.ravel(), cols2.ravel())).astype(np.intc)
+    return I, J
+
+def laplacianValues(r,c,d,dirn,intn,intw):
+    # matrix values in the order of laplacianStructure
+    N = r*c*d
+    M = 2*(r*c + r*d + c*d)
+    # For (negative) Laplacian, first column of values should be equal to negative sum of all others.
+    # Using -L keeps the interior rows (1-w)(-L)x + wx = wv positive definite, as the smoothing energy requires
+    V1 = -np.ones((N, 7))
     V1[:, 0] = -np.sum(V1[:, 1:], axis=1)
     # applying Laplacian weights
     V1[intn, :] *= (1-intw[:,np.newaxis])
     # applying function estimate weight
     V1[intn, 0] += intw
 
-    # Use mask for Dirichlet conditions
-    msk = np.ones(np.shape(rows1), dtype=bool)
-    msk[dirn, 1:] = 0
-    V1[dirn,0] = 1
-    I[0:(P-2*M)] = rows1[msk].ravel()
-    J[0:(P-2*M)] = cols1[msk].ravel()
-    V[0:(P-2*M)] = V1[msk].ravel()
-    I[P-2*M:] = rows2.ravel()
-    J[P-2*M:] = cols2.ravel()
-    V[P-2*M:] = V2.ravel()
+    # Dirichlet conditions
+    V1[dirn, 1:] = 0
+    V1[dirn, 0] = 1
 
+    # ghost nodes equal their boundary node
+    V2 = np.ones((M,2))
+    V2[:,1] = -1
+    return np.concatenate((V1.ravel(), V2.ravel()))
 
-    b = np.zeros(N + M, dtype=np.double)
+def laplacianRHS(n, dirn, dirv, intn, intv, intw):
+    b = np.zeros(n, dtype=np.double)
     # updating b vector for Dirichlet and interior nodes
     b[dirn] = dirv
     b[intn] = intw*intv
+    return b
 
-    # can use sparse.linalg.spsolve from scipy.sparse
-    A = sparse.coo_matrix((V, (I,J)), shape=(N+M, N+M))
+def reducedSystem(r,c,d,dirn,dirv,intn,intv,intw):
+    # Symmetric positive definite form of the same problem on the N grid nodes only, for Krylov solvers.
+    # A ghost node equal to its boundary node adds nothing to the Laplacian, so Neumann boundaries just
+    # lower the diagonal. Interior rows are divided by (1-w), and Dirichlet nodes (plus interior nodes
+    # with w>=1, whose row reduces to x=v) are eliminated into the right hand side.
+    # Returns S (csr), b, the free node numbers and phi (flat, with the Dirichlet values filled in)
+    N = r*c*d
+    fixed, phi, cw, v = gridCoefficients(r,c,d,dirn,dirv,intn,intv,intw)
+
+    free = np.nonzero(~fixed)[0]
+    fid = -np.ones(N, dtype=np.int64)
+    fid[free] = np.arange(len(free))
+    b = cw * v
+    diag = cw.copy()
+
+    I = []
+    J = []
+    nd = np.arange(N).reshape((r,c,d), order='F')
+    for p, q in ((nd[:-1,:,:], nd[1:,:,:]), (nd[:,:-1,:], nd[:,1:,:]), (nd[:,:,:-1], nd[:,:,1:])):
+        p = p.ravel()
+        q = q.ravel()
+        # each grid edge adds one to the diagonal of both of its nodes
+        diag[p] += 1
+        diag[q] += 1
+        m = ~fixed[p] & ~fixed[q]
+        I += [fid[p[m]], fid[q[m]]]
+        J += [fid[q[m]], fid[p[m]]]
+        # known neighbours move to the right hand side
+        m = ~fixed[p] & fixed[q]
+        b[p[m]] += phi[q[m]]
+        m = fixed[p] & ~fixed[q]
+        b[q[m]] += phi[p[m]]
+
+    I.append(np.arange(len(free)))
+    J.append(np.arange(len(free)))
+    I = np.concatenate(I)
+    J = np.concatenate(J)
+    V = -np.ones(len(I))
+    V[-len(free):] = diag[free]
+    S = sparse.csr_matrix((V, (I, J)), shape=(len(free), len(free)))
+    return S, b[free], free, phi
+
+def gridCoefficients(r,c,d,dirn,dirv,intn,intv,intw):
+    # per node (flat, node number order): known-node mask, known values, data weight w/(1-w) and data value
+    N = r*c*d
+    w = np.zeros(N)
+    w[intn] = intw
+    v = np.zeros(N)
+    v[intn] = intv
+    fixed = w >= 1
+    phi = np.where(fixed, v, 0.)
+    fixed[dirn] = True
+    phi[dirn] = dirv
+    free = ~fixed
+    cw = np.zeros(N)
+    cw[free] = w[free] / (1 - w[free])
+    return fixed, phi, cw, v
+
+def neighbourSum(u):
+    # sum of the 6-connected neighbours of every voxel of the 3D array u. Missing neighbours outside
+    # the grid contribute nothing, which is the Neumann (ghost node) boundary condition
+    s = np.zeros_like(u)
+    s[1:,:,:] += u[:-1,:,:]
+    s[:-1,:,:] += u[1:,:,:]
+    s[:,1:,:] += u[:,:-1,:]
+    s[:,:-1,:] += u[:,1:,:]
+    s[:,:,1:] += u[:,:,:-1]
+    s[:,:,:-1] += u[:,:,1:]
+    return s
+
+def laplacianOperator(r,c,d,dirn,dirv,intn,intv,intw):
+    # Matrix-free version of reducedSystem over all N nodes: known nodes are identity rows, free nodes
+    # apply (deg + w/(1-w)) x - sum of free neighbours with stencils on the 3D array. The operator is
+    # symmetric positive definite and only keeps the known-node mask and the diagonal (9 bytes per voxel).
+    # Returns the LinearOperator A, the right hand side b and the diagonal of A
+    fixed, phi, cw, v = gridCoefficients(r,c,d,dirn,dirv,intn,intv,intw)
+    fixed = np.reshape(fixed, [r,c,d], order='F')
+    phi = np.reshape(phi, [r,c,d], order='F')
+    deg = neighbourSum(np.ones((r,c,d)))
+    diag = np.where(fixed, 1, deg + np.reshape(cw, [r,c,d], order='F'))
+    # known neighbours move to the right hand side
+    b = np.where(fixed, phi, np.reshape(cw * v, [r,c,d], order='F') + neighbourSum(phi))
+    del cw, v, deg, phi
+
+    def matvec(x):
+        u = np.reshape(x, [r,c,d], order='F')
+        y = diag * u - np.where(fixed, 0, neighbourSum(np.where(fixed, 0, u)))
+        return np.ravel(y, order='F')
+
+    N = r*c*d
+    A = sparse.linalg.LinearOperator((N, N), matvec=matvec, rmatvec=matvec, dtype=np.double)
+    return A, np.ravel(b, order='F'), np.ravel(diag, order='F')
+
+def preconditioner(S, precond, shape=None, free=None):
+    # returns a LinearOperator approximating S^-1, or None.
+    # 'multigrid' needs the grid shape and free node numbers of reducedSystem
+    if precond is None:
+        return None
+    if precond == 'multigrid':
+        mg = multigrid(S, shape, free)
+        return sparse.linalg.LinearOperator(S.shape, matvec=lambda x: mg.vcycle(0, x), dtype=np.double)
+    if precond == 'jacobi':
+        dinv = 1 / S.diagonal()
+        return sparse.linalg.LinearOperator(S.shape, matvec=lambda x: dinv * x)
+    if precond == 'ilu':
+        ilu = sparse.linalg.spilu(S.tocsc(), drop_tol=1e-4, fill_factor=10)
+        return sparse.linalg.LinearOperator(S.shape, matvec=ilu.solve)
+    raise ValueError(f'Unknown preconditioner {precond}')
+
+def iterativeSolve(S, b, solver='cg', M=None, tol=1e-8, maxiter=1000, x0=None, history=False):
+    # solve S x = b (matrix or LinearOperator) with a Krylov method and preconditioner M.
+    # Returns x and a dict with the iteration count, the convergence flag and the relative residuals: after
+    # every iteration if history is set (one extra product with S per iteration), otherwise only the final one.
+    # Warns if the solver stops at maxiter before reaching tol
+    if solver == 'cg':
+        method = sparse.linalg.cg
+    elif solver == 'bicgstab':
+        method = sparse.linalg.bicgstab
+    else:
+        raise ValueError(f'Unknown solver {solver}')
+
+    nb = max(np.linalg.norm(b), 1e-300)
+    residuals = []
+    iterations = [0]
+    def callback(xk):
+        iterations[0] += 1
+        if history:
+            residuals.append(np.linalg.norm(b - S @ xk) / nb)
+
+    x, info = method(S, b, x0=x0, rtol=tol, maxiter=maxiter, M=M, callback=callback)
+    if info < 0:
+        raise RuntimeError(f'{solver} failed with info={info}')
+    if not residuals:
+        residuals.append(np.linalg.norm(b - S @ x) / nb)
+    if info > 0:
+        warnings.warn(f'{solver} did not converge in {info} iterations (relative residual {residuals[-1]:.1e}, '
+                      f'tol {tol:.1e})', RuntimeWarning)
+    return x, {'residuals': residuals, 'iterations': iterations[0], 'converged': info == 0}
+
+def prolongation1D(nf):
+    # linear interpolation from the nc=(nf+1)//2 coarse nodes (at the even fine nodes) to nf fine nodes
+    nc = (nf + 1) // 2
+    i = np.arange(nf)
+    I = [i[0::2], i[1::2], i[1::2]]
+    J = [i[0::2] // 2, i[1::2] // 2, np.minimum(i[1::2] // 2 + 1, nc - 1)]
+    V = [np.ones(len(I[0])), 0.5 * np.ones(len(I[1])), 0.5 * np.ones(len(I[2]))]
+    return sparse.csr_matrix((np.concatenate(V), (np.concatenate(I), np.concatenate(J))), shape=(nf, nc))
+
+class multigrid:
+    # Geometric multigrid for the reduced system S of reducedSystem (free nodes of an r x c x d grid).
+    # Each level halves the grid; trilinear prolongation is restricted to the free fine nodes, so known
+    # (Dirichlet) nodes never receive a correction, and the coarse operators are Galerkin products
+    # P^T S P, which carry the interior weights down. Jacobi smoothing damped by omega/rho(D^-1 A) on every
+    # level (the Galerkin operators have 27-point stencils, so a fixed damping is not stable everywhere),
+    # direct solve on the coarsest level.
+    # If S is the full N x N system of LaplacianSystem (known nodes as identity rows), pass free=arange(N)
+    # and the known-node mask as fixed so that those rows get no coarse correction either.
+    def __init__(self, S, shape, free, nu=2, omega=4/3, coarsest=2000, fixed=None):
+        self.nu = nu # pre and post smoothing sweeps
+        self.omega = omega
+        self.A = [S.tocsr()]
+        self.P = []
+        self.Dinv = [self.smoother(self.A[0])]
+        while self.A[-1].shape[0] > coarsest and np.max(shape) > 2:
+            cshape = tuple((n + 1) // 2 for n in shape)
+            P = sparse.kron(prolongation1D(shape[2]), sparse.kron(prolongation1D(shape[1]),
+                                                                  prolongation1D(shape[0]))).tocsr()
+            P = P[free, :]
+            if fixed is not None:
+                P = (sparse.diags((~fixed).astype(np.double)) @ P).tocsr()
+                P.eliminate_zeros()
+                fixed = None
+            # coarse nodes that no free fine node interpolates from carry no unknown
+            keep = np.nonzero(np.diff(P.tocsc().indptr) > 0)[0]
+            P = P[:, keep].tocsr()
+            Ac = (P.T @ self.A[-1] @ P).tocsr()
+            self.P.append(P)
+            self.A.append(Ac)
+            self.Dinv.append(self.smoother(Ac))
+            shape = cshape
+            free = keep
+        self.coarse = sparse.linalg.splu(self.A[-1].tocsc())
+
+    def smoother(self, A, iters=15):
+        # damped inverse diagonal omega/rho * D^-1, with the spectral radius rho of D^-1 A from power iteration
+        dinv = 1 / A.diagonal()
+        x = np.random.default_rng(0).random(A.shape[0])
+        rho = 1
+        for i in range(iters):
+            y = dinv * (A @ x)
+            rho = np.linalg.norm(y) / np.linalg.norm(x)
+            x = y / np.linalg.norm(y)
+        return self.omega / (1.05 * rho) * dinv
+
+    def vcycle(self, l, b, x=None):
+        # one V-cycle on level l for A[l] x = b, starting from x (zero if None)
+        if l == len(self.P):
+            return self.coarse.solve(b)
+        A = self.A[l]
+        if x is None:
+            x = self.Dinv[l] * b
+            sweeps = self.nu - 1
+        else:
+            x = x.copy()
+            sweeps = self.nu
+        for i in range(sweeps):
+            x += self.Dinv[l] * (b - A @ x)
+        x += self.P[l] @ self.vcycle(l + 1, self.P[l].T @ (b - A @ x))
+        for i in range(self.nu):
+            x += self.Dinv[l] * (b - A @ x)
+        return x
+
+    def fmg(self, b):
+        # full multigrid: solve on the coarsest level, then interpolate and V-cycle up to the finest
+        bs = [b]
+        for P in self.P:
+            bs.append(P.T @ bs[-1])
+        x = self.coarse.solve(bs[-1])
+        for l in range(len(self.P) - 1, -1, -1):
+            x = self.vcycle(l, bs[l], self.P[l] @ x)
+        return x
+
+    def solve(self, b, x0=None, tol=1e-8, maxiter=100):
+        # FMG (or the warm start x0) followed by V-cycles until the relative residual is below tol.
+        # Returns x and the relative residual after every cycle
+        nb = max(np.linalg.norm(b), 1e-300)
+        x = self.fmg(b) if x0 is None else self.vcycle(0, b, x0)
+        residuals = [np.linalg.norm(b - self.A[0] @ x) / nb]
+        while residuals[-1] > tol and len(residuals) < maxiter:
+            x = self.vcycle(0, b, x)
+            residuals.append(np.linalg.norm(b - self.A[0] @ x) / nb)
+        if residuals[-1] > tol:
+            warnings.warn(f'multigrid did not converge in {maxiter} cycles (relative residual {residuals[-1]:.1e}, '
+                          f'tol {tol:.1e})', RuntimeWarning)
+        return x, residuals
+
+
+class LaplacianSystem:
+    # Laplacian smoothing system for one r x c x d grid that is reused across solves.
+    # The sparsity structure (including the Neumann ghost node wiring for 'direct') is built once per shape;
+    # setMasks writes new matrix values in place when dirn/intn/intw change, and the factorization,
+    # preconditioner or multigrid hierarchy is kept until they change again, so repeated solves with new
+    # right hand sides (dirv, intv) only pay for the solve.
+    # solver: 'direct' (splu of the ghost node system), 'cg', 'bicgstab' or 'multigrid'. The iterative
+    # solvers use an N x N form of reducedSystem where known nodes are identity rows, so its pattern does not
+    # depend on the masks either.
+    def __init__(self, r, c, d, solver='direct', precond=None, tol=1e-8, maxiter=1000):
+        checkOptions(solver, precond)
+        self.r, self.c, self.d = r, c, d
+        self.solver = solver
+        self.precond = precond
+        self.tol = tol
+        self.maxiter = maxiter
+        N = r*c*d
+        if solver == 'direct':
+            I, J = laplacianStructure(r,c,d)
+            n = N + 2*(r*c + r*d + c*d)
+        else:
+            nd = np.arange(N, dtype=np.intc).reshape((r,c,d), order='F')
+            p = np.concatenate((nd[:-1,:,:].ravel(), nd[:,:-1,:].ravel(), nd[:,:,:-1].ravel()))
+            q = np.concatenate((nd[1:,:,:].ravel(), nd[:,1:,:].ravel(), nd[:,:,1:].ravel()))
+            self.edges = (p, q)
+            I = np.concatenate((p, q, nd.ravel(order='F')))
+            J = np.concatenate((q, p, nd.ravel(order='F')))
+            n = N
+        # mark every entry with its position so values given in (I, J) order can be scattered into A.data
+        A = sparse.coo_matrix((np.arange(1, len(I) + 1, dtype=np.double), (I, J)), shape=(n, n))
+        self.A = A.tocsc() if solver == 'direct' else A.tocsr()
+        self.order = self.A.data.astype(np.int64) - 1
+        self.masks = None
+        self.factor = None
+
+    def setMasks(self, dirn, intn, intw):
+        # update the matrix values for new Dirichlet/interior nodes and weights; no-op if nothing changed
+        if self.masks is not None and all(np.array_equal(a, b) for a, b in zip(self.masks, (dirn, intn, intw))):
+            return
+        self.masks = (np.copy(dirn), np.copy(intn), np.copy(intw))
+        r, c, d = self.r, self.c, self.d
+        if self.solver == 'direct':
+            V = laplacianValues(r,c,d,dirn,intn,intw)
+        else:
+            self.fixed, self.known, self.cw, v = gridCoefficients(r,c,d,dirn,np.zeros(len(dirn)),intn,
+                                                                 np.zeros(len(intn)),intw)
+            p, q = self.edges
+            coupled = np.where(self.fixed[p] | self.fixed[q], 0., -1.)
+            deg = np.ravel(neighbourSum(np.ones((r,c,d))), order='F')
+            V = np.concatenate((coupled, coupled, np.where(self.fixed, 1, deg + self.cw)))
+        self.A.data[:] = V[self.order]
+        self.factor = None
 
-    # For large systems, DLL implementation of biconjugate gradient solver is MUCH faster
-    # bc = bicg()
-    # x = bc.Solve(N+M, N+M, I, J, V, b, maxiter=1000)
-    x = sparse.linalg.spsolve(A.tocsc(),b)
+    def prepare(self):
+        # factorization / preconditioner for the current values
+        if self.solver == 'direct':
+            self.factor = sparse.linalg.splu(self.A)
+        elif self.solver == 'multigrid' or self.precond == 'multigrid':
+            N = self.r*self.c*self.d
+            self.factor = multigrid(self.A, (self.r, self.c, self.d), np.arange(N), fixed=self.fixed)
+        else:
+            self.factor = preconditioner(self.A, self.precond)
 
+    def solve(self, dirv, intv, x0=None, return_info=False, dirn=None, intn=None, intw=None):
+        # solve for new right hand side values. dirn/intn/intw, if given, update the masks first
+        t = time.perf_counter()
+        if dirn is not None:
+            self.setMasks(dirn, intn, intw)
+        dirn, intn, intw = self.masks
+        if self.factor is None:
+            self.prepare()
+        r, c, d = self.r, self.c, self.d
+        N = r*c*d
 
-    phi = np.reshape(x[0:N], [r,c,d], order='F')
+        converged = True
+        if self.solver == 'direct':
+            b = laplacianRHS(self.A.shape[0], dirn, dirv, intn, intv, intw)
+            x = self.factor.solve(b)
+            residuals = [np.linalg.norm(b - self.A @ x) / max(np.linalg.norm(b), 1e-300)]
+            iterations = 1
+            x = x[0:N]
+        else:
+            # known values: Dirichlet nodes and interior nodes with w>=1 (x=v)
+            v = np.zeros(N)
+            v[intn] = intv
+            known = np.where(self.fixed, v, 0)
+            known[dirn] = dirv
+            b = np.where(self.fixed, known, self.cw * v +
+                         np.ravel(neighbourSum(np.reshape(known, [r,c,d], order='F')), order='F'))
+            x0 = known if x0 is None else np.where(self.fixed, known, np.ravel(x0, order='F'))
+            if self.solver == 'multigrid':
+                x, residuals = self.factor.solve(b, x0, self.tol, self.maxiter)
+                iterations = len(residuals)
+                converged = residuals[-1] <= self.tol
+            else:
+                M = self.factor
+                if self.precond == 'multigrid':
+                    M = sparse.linalg.LinearOperator(self.A.shape, matvec=lambda y: self.factor.vcycle(0, y),
+                                                     dtype=np.double)
+                x, info = iterativeSolve(self.A, b, self.solver, M, self.tol, self.maxiter, x0, return_info)
+                residuals, iterations, converged = info['residuals'], info['iterations'], info['converged']
 
-    return phi
\ No newline at end of file
+        phi = np.reshape(x, [r,c,d], order='F')
+        if return_info:
+            return phi, {'solver': self.solver, 'precond': self.precond, 'iterations': iterations,
+                         'converged': converged, 'residuals': residuals, 'time': time.perf_counter() - t}
+        return phi
@@ -6,6 +6,9 @@
 # % Modified by: Andre Hucke > Added gradientNB, curvatureNB, DuDt2 functions
 # % Parts of this code were created using AI. All code was reviewed and modified by the author.
 
+import os
+import time
+import contextlib
 import numpy as np
 from fastMarching import *
 import skimage.filters
@@ -15,7 +18,9 @@ from laplacianSmoothing import *
 class levelSetParams:
     def __init__(self, method=None, alpha=.2, mindist=3.1, sigma=.5, inflation=1, tau=1, beta=0.1,
                  epsilon=1e-7, maxiter=1000, convthrsh=1e-2, reinitrate=1, visrate=0, dtt=None,
-                 lmbda=1, mu=1, gvft=.9):
+                 lmbda=1, mu=1, gvft=.9, checkpoint=None, checkpointrate=0,
+                 adaptive=False, cfl=1., dtgrow=1.5, dtshrink=0.5, dtflip=0.3, gvfsolver='direct', gvfprecond=None,
+                 gvfmatrixfree=False):
         if method is None:
             self.method='CS' # or 'CV' or 'GVF'
         else:
@@ -40,6 +45,63 @@ class levelSetParams:
         self.lmbda = lmbda # slide 36
         self.mu = mu     # slide 36
         self.gvft = gvft # slide 39 rho
+        self.checkpoint = checkpoint # .npz file the solver state is periodically saved to (see levelSet.resume)
+        self.checkpointrate = checkpointrate # how many LS updates between checkpoints (0 disables)
+        self.adaptive = adaptive # pick dt from the CFL/curvature limits instead of the dtt schedule
+        self.cfl = cfl # max change of the level set per update, in voxels
+        self.dtgrow = dtgrow # step scale growth factor while the band update is monotone
+        self.dtshrink = dtshrink # step scale reduction factor when the band update oscillates
+        self.dtflip = dtflip # fraction of band voxels whose update changed sign that counts as oscillating
+        self.gvfsolver = gvfsolver # laplacianSmoothing solver for the GVF field: 'direct', 'cg', 'bicgstab' or 'multigrid'
+        self.gvfprecond = gvfprecond # laplacianSmoothing preconditioner: None, 'jacobi', 'ilu' or 'multigrid'
+        self.gvfmatrixfree = gvfmatrixfree # apply the GVF Laplacian with stencils instead of a sparse matrix (cg/bicgstab only)
+        checkOptions(gvfsolver, gvfprecond, gvfmatrixfree)
+
+
+class levelSetReport:
+    # per-phase wall clock timers and counters for one level set run.
+    # Phases are 'features', 'reinit', 'convergence', 'curvature', 'means', 'dudt', 'update',
+    # 'separate', 'checkpoint' and 'plot'
+    def __init__(self):
+        self.times = {} # total seconds per phase
+        self.counts = {} # number of calls per phase
+        self.band = [] # narrow band size at every update
+        self.iterations = 0
+        self.current = {} # seconds per phase in the current iteration
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            t = time.perf_counter() - t
+            self.times[name] = self.times.get(name, 0) + t
+            self.counts[name] = self.counts.get(name, 0) + 1
+            self.current[name] = self.current.get(name, 0) + t
+
+    def endIteration(self, iter, band, callback=None):
+        # close the current iteration and hand its record to callback, if given
+        record = {'iter': iter, 'band': band, 'times': self.current}
+        self.band.append(band)
+        self.iterations += 1
+        self.current = {}
+        if callback is not None:
+            callback(record)
+
+    def summary(self):
+        return {'iterations': self.iterations, 'total': sum(self.times.values()),
+                'times': dict(self.times), 'counts': dict(self.counts),
+                'meanband': np.mean(self.band) if len(self.band)>0 else 0}
+
+    def __str__(self):
+        tot = sum(self.times.values())
+        lines = [f'{self.iterations} iterations, {tot:.3f} s, mean band size '
+                 f'{np.mean(self.band) if len(self.band)>0 else 0:.0f}']
+        for name in sorted(self.times, key=self.times.get, reverse=True):
+            lines.append(f'  {name:12s}{self.times[name]:10.3f} s {100*self.times[name]/max(tot,1e-12):6.1f}% '
+                         f'{self.counts[name]:8d} calls')
+        return '\n'.join(lines)
 
 
 class levelSet:
@@ -47,6 +109,7 @@ class levelSet:
         self.fm = fastMarching()
         self.r=self.c=self.d=0
         self.normG = None
+        self.report = levelSetReport()
 
     def DuDt1(self,v,tau,speed,nG,kappa,G,gradspeed): # Casselle Sapiro
         return speed * nG * (kappa + v) + tau * np.sum(G * gradspeed,axis=0) # slide 34
@@ -69,8 +132,9 @@ class levelSet:
         # Vectorized computation of Chan-Vese energy terms
         energy_difference = (img - c1)**2 - (img - c2)**2
         
-        # Regularized Chan-Vese update formula: μ * κ - λ * (F1 - F2)
-        dudt = mu * kappa - lmbda * energy_difference
+        # Regularized Chan-Vese update formula: μ * κ + λ * (F1 - F2)
+        # The distance maps are negative inside, so a voxel closer to the outside mean (F1 > F2) moves out
+        dudt = mu * kappa + lmbda * energy_difference
         
         return dudt
 
@@ -92,23 +156,29 @@ class levelSet:
             gradim[2,:,:,-1] = img[:,:,-1] - img[:,:,-2]
         return gradim
 
-    def gradientNB(self):
+    def gradientNB(self, fm=None):
         """
         Compute gradients of the distance map for voxels in the narrow band.
         
+        Args:
+            fm: fastMarching object holding the distance map (defaults to self.fm)
+
         Returns:
             G: Gradient vectors (3xN array)
             xyz: Coordinates of the narrow band voxels (3xN array)
             xf, xb, yf, yb, zf, zb: Forward and backward neighbor coordinates
         """
+        if fm is None:
+            fm = self.fm
+
         # Get the narrow band voxels
-        nbin, nbout = self.fm.getNB()
+        nbin, nbout = fm.getNB()
         nb = np.concatenate((nbin, nbout), axis=0)
         
         # Get the number of voxels in the narrow band
         N = len(nb)
         if N == 0:
-            return np.zeros((3, 0)), np.zeros((3, 0)), [], [], [], [], [], []
+            return np.zeros((3, 0)), np.zeros((3, 0), dtype=int), [], [], [], [], [], []
         
         # Extract coordinates
         x = np.array([node.x for node in nb], dtype=int)
@@ -132,15 +202,15 @@ class levelSet:
         # Compute gradients using central differences where possible
         # At boundaries, forward or backward differences are automatically used
         # The denominator is 2 for central differences and 1 for one-sided differences
-        G[0, :] = (self.fm.dmap[xf, y, z] - self.fm.dmap[xb, y, z]) / np.where(xf != xb, 2.0, 1.0)
-        G[1, :] = (self.fm.dmap[x, yf, z] - self.fm.dmap[x, yb, z]) / np.where(yf != yb, 2.0, 1.0)
-        G[2, :] = (self.fm.dmap[x, y, zf] - self.fm.dmap[x, y, zb]) / np.where(zf != zb, 2.0, 1.0)
+        G[0, :] = (fm.dmap[xf, y, z] - fm.dmap[xb, y, z]) / np.where(xf != xb, 2.0, 1.0)
+        G[1, :] = (fm.dmap[x, yf, z] - fm.dmap[x, yb, z]) / np.where(yf != yb, 2.0, 1.0)
+        G[2, :] = (fm.dmap[x, y, zf] - fm.dmap[x, y, zb]) / np.where(zf != zb, 2.0, 1.0)
         
         return G, xyz, xf, xb, yf, yb, zf, zb
 
-    def curvatureNB(self, epsilon):
+    def curvatureNB(self, epsilon, fm=None):
         """Compute mean curvature as divergence of normalized gradient."""
-        G, xyz, xf, xb, yf, yb, zf, zb = self.gradientNB()
+        G, xyz, xf, xb, yf, yb, zf, zb = self.gradientNB(fm)
         
         N = G.shape[1]
         if N == 0:
@@ -153,42 +223,30 @@ class levelSet:
         nG_safe = np.maximum(nG, epsilon)
         Gnorm = G / nG_safe
         
-        # Create 3D arrays for the normalized gradients for spatial indexing
-        normG_x = np.zeros((self.r, self.c, self.d))
-        normG_y = np.zeros((self.r, self.c, self.d))
-        normG_z = np.zeros((self.r, self.c, self.d))
-        
+        # self.normG is a full-volume scratch array that is zero outside the narrow band.
+        # It is allocated once per segment call and shared by every interface being evolved.
+        if self.normG is None or self.normG.shape != (3, self.r, self.c, self.d):
+            self.normG = np.zeros((3, self.r, self.c, self.d))
+
         # Fill in the normalized gradients for the narrow band voxels
         x, y, z = xyz[0, :], xyz[1, :], xyz[2, :]
-        normG_x[x, y, z] = Gnorm[0, :]
-        normG_y[x, y, z] = Gnorm[1, :]
-        normG_z[x, y, z] = Gnorm[2, :]
+        self.normG[:, x, y, z] = Gnorm
         
-        # Compute divergence of normalized gradient field for each point
-        kappa = np.zeros(N)
-        
-        for i in range(N):
-            # Get normalized gradients at neighbors using spatial indexing
-            nx_f = normG_x[xf[i], y[i], z[i]]
-            nx_b = normG_x[xb[i], y[i], z[i]]
-            ny_f = normG_y[x[i], yf[i], z[i]]
-            ny_b = normG_y[x[i], yb[i], z[i]]
-            nz_f = normG_z[x[i], y[i], zf[i]]
-            nz_b = normG_z[x[i], y[i], zb[i]]
-            
-            # Compute partial derivatives of normalized gradient components
-            dx_nx = (nx_f - nx_b) / (xf[i] - xb[i] if xf[i] != xb[i] else 1.0)
-            dy_ny = (ny_f - ny_b) / (yf[i] - yb[i] if yf[i] != yb[i] else 1.0)
-            dz_nz = (nz_f - nz_b) / (zf[i] - zb[i] if zf[i] != zb[i] else 1.0)
-            
-            # Divergence is sum of partial derivatives
-            kappa[i] = dx_nx + dy_ny + dz_nz
+        # Divergence of normalized gradient field is sum of partial derivatives
+        kappa = ((self.normG[0, xf, y, z] - self.normG[0, xb, y, z]) / np.where(xf != xb, xf - xb, 1) +
+                 (self.normG[1, x, yf, z] - self.normG[1, x, yb, z]) / np.where(yf != yb, yf - yb, 1) +
+                 (self.normG[2, x, y, zf] - self.normG[2, x, y, zb]) / np.where(zf != zb, zf - zb, 1))
+
+        # clear the band again so the scratch array can be reused
+        self.normG[:, x, y, z] = 0
         
         return kappa, G, nG, xyz
 
-    def segment(self, img, dmap_init, params=levelSetParams(), ax=None):
+    def imageFeatures(self, img, params):
+        # precompute the image-derived terms used by the level set speed functions.
+        # Returns speed, gradspeed, gvf (None where the method does not need them)
         self.r,self.c,self.d = np.shape(img)
-        self.normG = np.zeros((3,self.r,self.c,self.d))
+        speed = gradspeed = gvf = None
 
         if params.method != 'CV':
             if params.sigma > 0:
@@ -210,18 +268,21 @@ class levelSet:
             ngradspeed = np.linalg.norm(gradspeed, axis=0)
             mx = np.max(ngradspeed)
             msk = np.ravel(ngradspeed>params.gvft*mx, order='F')
-            imsk = 1-msk
+            imsk = ~msk
             dirn = X[msk] + self.r*(Y[msk] + self.c*Z[msk])
             intn = X[imsk] + self.r*(Y[imsk] + self.c*Z[imsk])
-            gvfx = laplacianSmoothing(self.r,self.c,self.d,dirn,gradspeed[0,X[msk],Y[msk],Z[msk]],
-                                      intn,gradspeed[0, X[imsk], Y[imsk], Z[imsk]],
-                                      (ngradspeed[X[imsk],Y[imsk],Z[imsk]] / (params.gvft * mx))**2) # see 39
-            gvfy = laplacianSmoothing(self.r,self.c,self.d,dirn,gradspeed[1,X[msk],Y[msk],Z[msk]],
-                                      intn,gradspeed[1,X[imsk],Y[imsk],Z[imsk]],
-                                      (ngradspeed[X[imsk],Y[imsk],Z[imsk]] / (params.gvft * mx))**2)
-            gvfz = laplacianSmoothing(self.r,self.c,self.d,dirn,gradspeed[2,X[msk],Y[msk],Z[msk]],
-                                      intn,gradspeed[2,X[imsk],Y[imsk],Z[imsk]],
-                                      (ngradspeed[X[imsk],Y[imsk],Z[imsk]] / (params.gvft * mx))**2)
+            intw = (ngradspeed[X[imsk],Y[imsk],Z[imsk]] / (params.gvft * mx))**2 # see 39
+            if params.gvfmatrixfree:
+                gvfx, gvfy, gvfz = [laplacianSmoothing(self.r,self.c,self.d,dirn,gradspeed[i,X[msk],Y[msk],Z[msk]],
+                                                       intn,gradspeed[i,X[imsk],Y[imsk],Z[imsk]],intw,
+                                                       solver=params.gvfsolver, precond=params.gvfprecond,
+                                                       matrixfree=True) for i in range(3)]
+            else:
+                # the three components share one system; it is factored (or preconditioned) once
+                lsys = LaplacianSystem(self.r,self.c,self.d, params.gvfsolver, params.gvfprecond)
+                lsys.setMasks(dirn, intn, intw)
+                gvfx, gvfy, gvfz = [lsys.solve(gradspeed[i,X[msk],Y[msk],Z[msk]], gradspeed[i,X[imsk],Y[imsk],Z[imsk]])
+                                    for i in range(3)]
             gvf = np.concatenate((gvfx[np.newaxis,:,:,:], gvfy[np.newaxis,:,:,:], gvfz[np.newaxis,:,:,:]), axis=0)
             if params.visrate>0:
                 f = plt.gcf()
@@ -238,82 +299,389 @@ class levelSet:
                 plt.axes(axgvf[1,0])
                 plt.figure(f)
 
+        return speed, gradspeed, gvf
 
-        iter=0
+    def regionMeans(self, img, fore=None, back=None):
+        # Chan-Vese means inside (c1) and outside (c2); masks default to the inside/outside of self.fm.dmap
+        if fore is None:
+            fore = self.fm.dmap<=0
+        if back is None:
+            back = ~fore
+        return np.mean(img[fore]), np.mean(img[back])
+
+    def dudtNB(self, img, params, features, kappa, G, nG, xyz, means=None):
+        # evaluate the level set update for the narrow band voxels xyz.
+        # means are the Chan-Vese (c1, c2), computed from self.fm.dmap if not given
+        speed, gradspeed, gvf = features
+        if (params.method != 'CV') and (params.method != 'GVF'):
+            dudt = self.DuDt1(params.v,params.tau,speed[xyz[0,:], xyz[1,:], xyz[2,:]],nG,kappa, G,
+                              gradspeed[:,xyz[0,:],xyz[1,:],xyz[2,:]])
+        elif params.method == 'CV':
+            c1, c2 = self.regionMeans(img) if means is None else means
+            dudt = self.DuDt2(params.mu, params.lmbda, kappa, img[xyz[0,:], xyz[1,:], xyz[2,:]], c1, c2) # see slide 36
+
+        elif params.method == 'GVF':
+            gvfl = gvf[:,xyz[0,:],xyz[1,:],xyz[2,:]]
+            dudt = self.DuDt4(params.mu, params.tau, kappa, G, gvfl)
+        return dudt
+
+    def bandFirstLayer(self, fm=None):
+        # narrow band voxels within one voxel of the zero level set; useful for convergence
+        if fm is None:
+            fm = self.fm
+        nbin, nbout = fm.getNB()
+        nbinone = nbin
+        nboutone = nbout
+        for i in range(len(nbin)):
+            if nbin[i].d>1:
+                nbinone = nbin[0:i]
+                break
+        for i in range(len(nbout)):
+            if nbout[i].d>1:
+                nboutone = nbout[0:i]
+                break
+        return nbinone, nboutone
+
+    def bandDelta(self, nbinold, nboutold, fm=None):
+        # mean change of the distance map over the previous first layer of the band.
+        # returns None if the band is empty
+        if fm is None:
+            fm = self.fm
+        N = len(nbinold) + len(nboutold)
+        if N==0:
+            return None
+        delta = 0
+        if len(nbinold)>0:
+            x, y, z, d = np.array([[nd.x, nd.y, nd.z, nd.d] for nd in nbinold]).T
+            delta += np.sum(np.abs(-fm.dmap[x.astype(int), y.astype(int), z.astype(int)] - d))
+        if len(nboutold)>0:
+            x, y, z, d = np.array([[nd.x, nd.y, nd.z, nd.d] for nd in nboutold]).T
+            delta += np.sum(np.abs(fm.dmap[x.astype(int), y.astype(int), z.astype(int)] - d))
+        return delta / N
+
+    def showIteration(self, img, dmaps, iter, delta, ax):
+        colors = ['red', 'lime', 'cyan', 'magenta', 'yellow', 'orange']
+        plt.axes(ax[0])
+        plt.cla()
+        ax[0].imshow(img[:,:,self.d//2].T, 'gray')
+        X,Y = np.meshgrid(range(self.r),range(self.c),indexing="ij")
+        for k, dmap in enumerate(dmaps):
+            plt.contour(X,Y,dmap[:,:,self.d // 2],levels=[0.0],colors=colors[k%len(colors)])
+        plt.title(f'Iteration {iter}, Delta={delta}')
+        plt.axes(ax[1])
+        plt.cla()
+        plt.gca().imshow(np.min(dmaps, axis=0)[:,:,self.d//2].T, 'gray', vmin=-10, vmax=20)
+        for k, dmap in enumerate(dmaps):
+            plt.contour(X,Y,dmap[:,:,self.d // 2],levels=[0.0],colors=colors[k%len(colors)])
+        plt.title('Distance map')
+        plt.gcf().canvas.draw_idle()
+        plt.gcf().canvas.start_event_loop(0.01)
+
+    def segment(self, img, dmap_init, params=levelSetParams(), ax=None, callback=None):
+        # callback, if given, receives a record {'iter', 'band', 'times'} after every update;
+        # the totals for the whole run are in self.report
         self.fm.dmap = np.array(dmap_init, dtype=np.float64)
         self.fm.voxsz = np.array([1.,1.,1.])
-        delta=params.convthrsh+1
+        self.fm.nbin = []
+        self.fm.nbout = []
+        self.iter = 0
+        self.history = [] # convergence delta at every re-initialization
+        self.nbold = None
+        self.dthistory = [] # time step used at every update
+        self.dtscale = 1. # adaptive step scale relative to the CFL/diffusion limit, see adaptiveStep
+        self.prevstep = None # band voxel indices and update signs of the last update
+        return self.evolve(img, params, ax, callback)
+
+    def resume(self, img, checkpoint, params=None, ax=None, callback=None):
+        # continue a segment run from a file written with params.checkpoint.
+        # img must be the image the run was started with; params (e.g. a larger maxiter) overrides the saved ones
+        saved = self.loadCheckpoint(checkpoint)
+        if params is None:
+            params = saved
+        return self.evolve(img, params, ax, callback)
+
+    def evolve(self, img, params, ax=None, callback=None):
+        # level set loop for self.fm, starting from the state in self.iter, self.nbold and self.history
+        self.report = rep = levelSetReport()
+        with rep.phase('features'):
+            features = self.imageFeatures(img, params)
+        self.normG = np.zeros((3,self.r,self.c,self.d))
+
+        iter = self.iter
+        delta = self.history[-1] if len(self.history)>0 else params.convthrsh+1
+        nbold = self.nbold
 
         while iter < params.maxiter:
+            if params.checkpoint is not None and params.checkpointrate>0 and iter>self.iter \
+                    and iter%params.checkpointrate==0:
+                with rep.phase('checkpoint'):
+                    self.saveCheckpoint(params.checkpoint, params, iter, nbold)
+
             if iter%params.reinitrate==0:
-                self.fm.update(nbdist=params.mindist)
-
-                nbin, nbout = self.fm.getNB()
-                nbinone = nbin #useful for convergence
-                nboutone = nbout
-                for i in range(len(nbin)):
-                    if nbin[i].d>1:
-                        nbinone = nbin[0:i]
-                        break
-                for i in range(len(nbout)):
-                    if nbout[i].d>1:
-                        nboutone = nbout[0:i]
-                        break
-                if iter>0: # check convergence
-                    delta = 0
-                    for i in range(len(nbinold)):
-                        delta += np.abs(-self.fm.dmap[ nbinold[i].x,  nbinold[i].y,  nbinold[i].z] -  nbinold[i].d)
-                    for i in range(len(nboutold)):
-                        delta += np.abs(self.fm.dmap[nboutold[i].x, nboutold[i].y, nboutold[i].z] - nboutold[i].d)
-                    N = len(nbinold) + len(nboutold)
-                    if N==0:
+                with rep.phase('reinit'):
+                    self.fm.update(nbdist=params.mindist)
+
+                with rep.phase('convergence'):
+                    nbinone, nboutone = self.bandFirstLayer()
+                    if nbold is not None:
+                        delta = self.bandDelta(nbold[0], nbold[1])
+                if nbold is not None: # check convergence
+                    if delta is None:
                         break
-                    delta /= len(nbinold) + len(nboutold)
+                    self.history.append(delta)
                     if delta<params.convthrsh:
                         break
 
-                nbinold = nbinone
-                nboutold = nboutone
+                nbold = (nbinone, nboutone)
 
-            kappa, G, nG, xyz = self.curvatureNB(params.epsilon)
+            with rep.phase('curvature'):
+                kappa, G, nG, xyz = self.curvatureNB(params.epsilon)
             if np.sum(np.isnan(kappa))>0:
-                self.fm.update(nbdist=params.mindist)
-                kappa,G,nG,xyz = self.curvatureNB(params.epsilon)
-
-            if (params.method != 'CV') and (params.method != 'GVF'):
-                dudt = self.DuDt1(params.v,params.tau,speed[xyz[0,:], xyz[1,:], xyz[2,:]],nG,kappa, G,
-                                  np.concatenate((
-                                      gradspeed[0,xyz[0,:],xyz[1,:],xyz[2,:]][np.newaxis,:],
-                                      gradspeed[1,xyz[0,:],xyz[1,:],xyz[2,:]][np.newaxis,:],
-                                      gradspeed[2,xyz[0,:],xyz[1,:],xyz[2,:]][np.newaxis,:]), axis=0))
-            elif params.method == 'CV':
-                msk = self.fm.dmap<=0
-                c1 = np.mean(img[msk])
-                c2 = np.mean(img[1-msk])
-                dudt = self.DuDt2(params.mu, params.lmbda, kappa, img[xyz[0,:], xyz[1,:], xyz[2,:]], c1, c2) # see slide 36
-
-            elif params.method == 'GVF':
-                gvfl = gvf[:,xyz[0,:],xyz[1,:],xyz[2,:]]
-                dudt = self.DuDt4(params.mu, params.tau, kappa, G, gvfl)
+                with rep.phase('reinit'):
+                    self.fm.update(nbdist=params.mindist)
+                with rep.phase('curvature'):
+                    kappa,G,nG,xyz = self.curvatureNB(params.epsilon)
+
+            means = None
+            if params.method == 'CV':
+                with rep.phase('means'):
+                    means = self.regionMeans(img)
+            with rep.phase('dudt'):
+                dudt = self.dudtNB(img, params, features, kappa, G, nG, xyz, means)
 
             if len(dudt)>0:
-                dt = params.dtt[iter] / np.max(np.abs(dudt))
-                self.fm.dmap[xyz[0,:], xyz[1,:], xyz[2,:]] += dt * dudt # do level set update
+                with rep.phase('update'):
+                    if params.adaptive:
+                        dt = self.adaptiveStep(params, features, dudt, nG, xyz)
+                    else:
+                        dt = params.dtt[iter] / np.max(np.abs(dudt))
+                    self.dthistory.append(dt)
+                    self.fm.dmap[xyz[0,:], xyz[1,:], xyz[2,:]] += dt * dudt # do level set update
                 if params.visrate>0 and iter%params.visrate==0:
-                    plt.axes(ax[0])
-                    plt.cla()
-                    ax[0].imshow(img[:,:,self.d//2].T, 'gray')
-                    X,Y = np.meshgrid(range(self.r),range(self.c),indexing="ij")
-                    plt.contour(X,Y,self.fm.dmap[:,:,self.d // 2],levels=[0.0],colors='red')
-                    plt.title(f'Iteration {iter}, Delta={delta}')
-                    plt.axes(ax[1])
-                    plt.cla()
-                    plt.gca().imshow(self.fm.dmap[:,:,self.d//2].T, 'gray', vmin=-10, vmax=20)
-                    plt.contour(X,Y,self.fm.dmap[:,:,self.d // 2],levels=[0.0],colors='red')
-                    plt.title('Distance map')
-                    plt.gcf().canvas.draw_idle()
-                    plt.gcf().canvas.start_event_loop(0.01)
+                    with rep.phase('plot'):
+                        self.showIteration(img, [self.fm.dmap], iter, delta, ax)
+            rep.endIteration(iter, len(dudt), callback)
+            iter += 1
+
+        self.iter = iter
+        self.nbold = nbold
+        with rep.phase('reinit'):
+            self.fm.update(nbdist=params.mindist)
+        return self.fm.dmap
+
+    def adaptiveStep(self, params, features, dudt, nG, xyz):
+        # Step for this update: the smaller of the CFL limit (no band voxel moves more than params.cfl voxels)
+        # and the explicit diffusion limit of the curvature term, dt <= h^2/(2*3*b) with b its coefficient,
+        # scaled by self.dtscale. The scale shrinks when many band voxels reverse the sign of their update
+        # between iterations (oscillation) and grows while the band moves monotonically. The band is
+        # re-initialized every few updates, so the diffusion limit is conservative and the scale may grow
+        # above 1 until the CFL limit, which is never exceeded, is reached.
+        # On the synthetic phantoms of testAdaptiveStep this takes about as many iterations as a fixed step at
+        # the same CFL number (the few extra ones are spent growing the step), not fewer: the controller saves
+        # tuning a schedule, not iterations. With CS and cfl > 1 the front can keep jittering above convthrsh
+        vmax = np.max(np.abs(dudt))
+        dt = params.cfl / vmax
+        if params.method == 'CV' or params.method == 'GVF':
+            b = params.mu
+        else:
+            b = np.max(features[0][xyz[0,:], xyz[1,:], xyz[2,:]] * nG)
+        if b > 0:
+            dt = min(dt, 1 / (6 * b))
+        maxscale = params.cfl / vmax / dt
+
+        idx = np.ravel_multi_index(xyz, (self.r, self.c, self.d))
+        sgn = dudt > 0
+        if self.prevstep is not None:
+            common, i, j = np.intersect1d(idx, self.prevstep[0], return_indices=True)
+            if len(common) > 0:
+                flips = np.mean(sgn[i] != self.prevstep[1][j])
+                if flips > params.dtflip:
+                    self.dtscale *= params.dtshrink
+                elif flips < params.dtflip / 2:
+                    self.dtscale *= params.dtgrow
+        self.dtscale = min(self.dtscale, maxscale)
+        self.prevstep = (idx, sgn)
+        return self.dtscale * dt
+
+    def saveCheckpoint(self, fname, params, iter, nbold):
+        # save everything needed to continue the run at iteration iter.
+        # The file is written next to fname first and then renamed, so an interrupted save
+        # never destroys the previous checkpoint
+        def nodes(nb):
+            return np.array([[nd.x, nd.y, nd.z, nd.d] for nd in nb], dtype=np.float64).reshape(-1, 4)
+
+        state = {'dmap': self.fm.dmap, 'iter': iter, 'history': np.array(self.history),
+                 'nbin': nodes(self.fm.nbin), 'nbout': nodes(self.fm.nbout),
+                 'dthistory': np.array(self.dthistory), 'dtscale': self.dtscale}
+        if self.prevstep is not None:
+            state['previdx'], state['prevsgn'] = self.prevstep
+        if nbold is not None:
+            state['nbinold'] = nodes(nbold[0])
+            state['nboutold'] = nodes(nbold[1])
+        for key, val in vars(params).items():
+            if val is not None:
+                state['param_' + key] = val
+
+        tmp = fname + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez_compressed(f, **state)
+        os.replace(tmp, fname)
+
+    def loadCheckpoint(self, fname):
+        # restore solver state from a checkpoint file. Returns the levelSetParams the run was using
+        def nodes(arr):
+            return [lSNode(int(x), int(y), int(z), d) for x, y, z, d in arr]
+
+        with np.load(fname) as f:
+            self.fm.dmap = np.array(f['dmap'])
+            self.fm.voxsz = np.array([1.,1.,1.])
+            self.fm.nbin = nodes(f['nbin'])
+            self.fm.nbout = nodes(f['nbout'])
+            self.iter = int(f['iter'])
+            self.history = list(f['history'])
+            self.nbold = (nodes(f['nbinold']), nodes(f['nboutold'])) if 'nbinold' in f else None
+            self.dthistory = list(f['dthistory'])
+            self.dtscale = float(f['dtscale'])
+            self.prevstep = (np.array(f['previdx']), np.array(f['prevsgn'])) if 'previdx' in f else None
+            params = levelSetParams()
+            for key in f.files:
+                if key.startswith('param_'):
+                    val = f[key]
+                    setattr(params, key[6:], val.item() if val.ndim==0 else np.array(val))
+        self.r, self.c, self.d = np.shape(self.fm.dmap)
+        return params
+
+    def separate(self, fms, xyz, clip):
+        # Non-overlap projection (Losasso et al. 2006): wherever two or more interfaces claim a voxel,
+        # subtract the mean of the two smallest distances from every level set so exactly one stays negative.
+        # Only the band voxels xyz are visited; values are clipped to +-clip so far interior voxels
+        # (stored as +-INF by fast marching) do not blow up the shift.
+        # Ties would leave 0 (inside) in two maps, so every map but the closest is pushed strictly outside.
+        vals = np.array([fm.dmap[xyz[0,:], xyz[1,:], xyz[2,:]] for fm in fms])
+        vals = np.clip(vals, -clip, clip)
+        two = np.partition(vals, 1, axis=0)[0:2]
+        ovl = two[1] <= 0
+        if not np.any(ovl):
+            return 0
+        vals = vals[:, ovl] - (two[0, ovl] + two[1, ovl]) / 2
+        lose = np.arange(len(fms))[:, np.newaxis] != np.argmin(vals, axis=0)
+        vals[lose] = np.maximum(vals[lose], 1e-6)
+        x, y, z = xyz[:, ovl]
+        for k, fm in enumerate(fms):
+            fm.dmap[x, y, z] = vals[k]
+        return np.sum(ovl)
+
+    def separateAll(self, fms, clip):
+        # non-overlap projection over every voxel that is inside two or more objects. Fast marching can flip
+        # the sign of voxels next to the zero level set, so this runs after every re-initialization
+        xyz = np.array(np.nonzero(np.sum([fm.dmap<=0 for fm in fms], axis=0)>1))
+        if xyz.shape[1]==0:
+            return 0
+        return self.separate(fms, xyz, clip)
+
+    def segmentMulti(self, img, dmap_inits, params=levelSetParams(), ax=None, callback=None):
+        # Evolve several interfaces together. Image features (speed, GVF) and the curvature scratch
+        # array are computed once and shared, every interface is re-initialized in the same pass
+        # (fastMarching.updateMulti, which shares its scratch arrays across the interfaces),
+        # interfaces that have converged are frozen, and a non-overlap projection keeps the
+        # objects disjoint. Returns a list of distance maps, one per dmap_init.
+        # self.iter, self.history (per interface deltas) and self.dthistory (per interface steps, nan
+        # for frozen ones) are kept as in segment
+        self.report = rep = levelSetReport()
+        with rep.phase('features'):
+            features = self.imageFeatures(img, params)
+        self.normG = np.zeros((3,self.r,self.c,self.d))
+        K = len(dmap_inits)
+        self.fms = fms = [fastMarching() for k in range(K)]
+        for fm, dmap_init in zip(fms, dmap_inits):
+            fm.dmap = np.array(dmap_init, dtype=np.float64)
+            fm.voxsz = np.array([1.,1.,1.])
+        if K>1: # starting masks may overlap
+            self.separateAll(fms, params.mindist)
+
+        iter=0
+        self.history = []
+        self.dthistory = []
+        delta = np.full(K, params.convthrsh+1)
+        done = np.zeros(K, dtype=bool)
+        nbold = [None]*K
+        # adaptive step state (dtscale, prevstep) of every interface, see adaptiveStep
+        steps = [(1., None)]*K
+
+        while iter < params.maxiter and not np.all(done):
+            if iter%params.reinitrate==0:
+                # one reinitialization pass over all interfaces that are still moving
+                with rep.phase('reinit'):
+                    updateMulti([fms[k] for k in np.nonzero(~done)[0]], params.mindist)
+                for k in np.nonzero(~done)[0]:
+                    with rep.phase('convergence'):
+                        nbone = self.bandFirstLayer(fms[k])
+                        dk = self.bandDelta(nbold[k][0], nbold[k][1], fms[k]) if iter>0 else None
+                    if iter>0: # check convergence
+                        if dk is None or dk<params.convthrsh:
+                            done[k] = True
+                        if dk is not None:
+                            delta[k] = dk
+                    nbold[k] = nbone
+                if iter>0:
+                    self.history.append(delta.copy())
+                if K>1:
+                    with rep.phase('separate'):
+                        self.separateAll(fms, params.mindist)
+                if np.all(done):
+                    break
+
+            if params.method == 'CV':
+                with rep.phase('means'):
+                    fores = [fm.dmap<=0 for fm in fms]
+                    back = ~np.any(fores, axis=0)
+                    c2 = np.mean(img[back])
+                    means = [(np.mean(img[fore]), c2) for fore in fores]
+
+            bands = []
+            dts = np.full(K, np.nan)
+            for k in np.nonzero(~done)[0]:
+                with rep.phase('curvature'):
+                    kappa, G, nG, xyz = self.curvatureNB(params.epsilon, fms[k])
+                if np.sum(np.isnan(kappa))>0:
+                    with rep.phase('reinit'):
+                        updateMulti([fms[k]], params.mindist)
+                    if K>1:
+                        with rep.phase('separate'):
+                            self.separateAll(fms, params.mindist)
+                    with rep.phase('curvature'):
+                        kappa,G,nG,xyz = self.curvatureNB(params.epsilon, fms[k])
+
+                with rep.phase('dudt'):
+                    dudt = self.dudtNB(img, params, features, kappa, G, nG, xyz,
+                                       means[k] if params.method == 'CV' else None)
+                if len(dudt)>0:
+                    with rep.phase('update'):
+                        if params.adaptive:
+                            self.dtscale, self.prevstep = steps[k]
+                            dt = self.adaptiveStep(params, features, dudt, nG, xyz)
+                            steps[k] = (self.dtscale, self.prevstep)
+                        else:
+                            dt = params.dtt[iter] / np.max(np.abs(dudt))
+                        dts[k] = dt
+                        fms[k].dmap[xyz[0,:], xyz[1,:], xyz[2,:]] += dt * dudt # do level set update
+                    bands.append(xyz)
+            self.dthistory.append(dts)
+
+            if K>1 and len(bands)>0:
+                with rep.phase('separate'):
+                    self.separate(fms, np.concatenate(bands, axis=1), params.mindist)
+
+            if params.visrate>0 and iter%params.visrate==0:
+                with rep.phase('plot'):
+                    self.showIteration(img, [fm.dmap for fm in fms], iter, np.max(delta), ax)
+            rep.endIteration(iter, sum(b.shape[1] for b in bands), callback)
             iter += 1
 
-        self.fm.update(nbdist=params.mindist)
-        return self.fm.dmap
\ No newline at end of file
+        self.iter = iter
+        with rep.phase('reinit'):
+            updateMulti(fms, params.mindist)
+        if K>1:
+            with rep.phase('separate'):
+                self.separateAll(fms, params.mindist)
+        return [fm.dmap for fm in fms]
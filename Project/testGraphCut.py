@@ -0,0 +1,171 @@
+# % Timing and agreement checks for the graphCutBasic max-flow engines
+# % ECE 8396: Medical Image Segmentation
+# % Spring 2025
+
+import time
+import numpy as np
+from GraphCutBasic import *
+
+def graphCutPhantom(r=48, c=48, d=8, noise=0.3, seed=0):
+    # noisy bright box on a dark background with a block of source seeds inside and sink seeds in a corner
+    rng = np.random.default_rng(seed)
+    img = rng.normal(0, noise, (r, c, d))
+    img[r//8:3*r//8, c//8:3*c//8, :] += 1
+    source = np.ravel_multi_index(np.mgrid[r//5:r//5+4, c//5:c//5+4, 0:1].reshape(3, -1), (r, c, d), order='F')
+    sink = np.ravel_multi_index(np.mgrid[0:3, 0:3, 0:1].reshape(3, -1), (r, c, d), order='F')
+    return img, source, sink
+
+def compareEngines(shape=(48, 48, 8), lmbdas=(0.9, 0.5, 0.1, 0.01), sigmas=(0.1, 0.3, 1.)):
+    # BK vs highest-label push-relabel over the data/smoothness balance and the edge contrast.
+    # Low lmbda leaves few strong t-links so augmenting paths get long, which is where push-relabel
+    # is expected to catch up with BK. Both engines must return the same flow and mask
+    img, source, sink = graphCutPhantom(*shape)
+    print(f'{shape[0]}x{shape[1]}x{shape[2]} ({np.prod(shape)} voxels)')
+    print(f'{"lmbda":>6s}{"sigma":>6s}{"bk (s)":>9s}{"pr (s)":>9s}{"flow":>12s}  agree')
+    results = []
+    for lmbda in lmbdas:
+        for sigma in sigmas:
+            out = {}
+            for engine in ('bk', 'pushrelabel'):
+                g = graphCutBasic()
+                t = time.time()
+                msk = g.segment(img, source=source, sink=sink, sigma=sigma, lmbda=lmbda, engine=engine)
+                out[engine] = (time.time() - t, g.totcap, msk)
+            agree = (np.array_equal(out['bk'][2], out['pushrelabel'][2]) and
+                     abs(out['bk'][1] - out['pushrelabel'][1]) <= 1e-8*max(1., out['bk'][1]))
+            print(f'{lmbda:6.2f}{sigma:6.2f}{out["bk"][0]:9.3f}{out["pushrelabel"][0]:9.3f}{out["bk"][1]:12.4f}  {agree}')
+            results.append((lmbda, sigma, out['bk'][0], out['pushrelabel'][0], agree))
+    return results
+
+def dynamicSeeds(shape=(48, 48, 8), edits=5, seed=0):
+    # interactive session: add a few sink seeds inside the object at a time and re-cut with dynamic=True,
+    # compared with cutting the edited graph from scratch
+    img, source, sink = graphCutPhantom(*shape)
+    rng = np.random.default_rng(seed)
+    g = graphCutBasic()
+    t = time.time()
+    g.segment(img, source=source, sink=sink)
+    print(f'initial cut {time.time() - t:.3f} s')
+    for i in range(edits):
+        pts = rng.integers(shape[0]//8, 3*shape[0]//8, (3, 5))
+        pts[2] = rng.integers(0, shape[2], 5)
+        sink = np.concatenate([sink, np.ravel_multi_index(pts, shape, order='F')])
+        t = time.time()
+        msk = g.segment(img, source=source, sink=sink, dynamic=True)
+        tdyn = time.time() - t
+        # same soft t-links with the edited hard constraints, cut from zero flow
+        tl = g.tsoft.copy()
+        tl[source] = [g.K, 0]
+        tl[sink] = [0, g.K]
+        gs = graphCutBasic()
+        gs.N = img.size
+        gs.initEdges(img, np.full(img.size, 0.5))
+        nlinks = gs.getNlinks()
+        t = time.time()
+        mskref = gs.segment(img, nlinks=nlinks, tlinks=tl)
+        print(f'edit {i}: dynamic {tdyn:.3f} s, from scratch {time.time() - t:.3f} s, '
+              f'same cut {np.array_equal(msk, mskref) and abs(g.totcap - gs.totcap) <= 1e-8*gs.totcap}')
+    # a changed parameter is not a seed edit: dynamic=True must make the same full cut as a new object
+    msk = g.segment(img, source=source, sink=sink, lmbda=0.2, dynamic=True)
+    mskref = graphCutBasic().segment(img, source=source, sink=sink, lmbda=0.2)
+    print(f'new lmbda with dynamic=True: same as a full cut {np.array_equal(msk, mskref)}')
+
+def compareMultilevel(shape=(128, 128, 16), levels=(1, 2), band=2):
+    # full cut vs coarse-to-fine banded cuts. Differences outside the band are isolated specks of noise
+    # that the coarse cut cannot see
+    img, source, sink = graphCutPhantom(*shape, noise=0.2)
+    g = graphCutBasic()
+    t = time.time()
+    msk = g.segment(img, source=source, sink=sink, sigma=0.3)
+    print(f'full cut {time.time() - t:.3f} s, {np.prod(shape)} voxels, {np.sum(msk)} inside')
+    for lv in levels:
+        gb = graphCutBasic()
+        t = time.time()
+        mskb = gb.segment(img, source=source, sink=sink, sigma=0.3, levels=lv, band=band)
+        inband = np.zeros(np.prod(shape), dtype=bool)
+        inband[gb.band] = True
+        inband = np.reshape(inband, shape, order='F')
+        print(f'levels={lv}: {time.time() - t:.3f} s, band {len(gb.band)} voxels, {np.sum(mskb)} inside, '
+              f'{np.sum((msk != mskb) & inband)} differ in band, {np.sum((msk != mskb) & ~inband)} outside')
+
+def compareBlocks(shape=(64, 64, 16), blocks=(2, 4), workers=None):
+    # serial cut vs block decomposed BK cuts solved in a process pool; the cut and the flow must be identical.
+    # blocktime is the parallel block phase, mergetime the serial final pass across the block boundaries;
+    # serial time / mergetime is the best speed-up any number of cores could give
+    img, source, sink = graphCutPhantom(*shape)
+    g = graphCutBasic()
+    t = time.time()
+    msk = g.segment(img, source=source, sink=sink)
+    tserial = time.time() - t
+    print(f'serial bk: {tserial:.3f} s, flow {g.totcap:.4f}')
+    for b in blocks:
+        gb = graphCutBasic()
+        t = time.time()
+        mskb = gb.segment(img, source=source, sink=sink, blocks=b, workers=workers)
+        print(f'blocks={b}: {time.time() - t:.3f} s (blocks {gb.blocktime:.3f} s, merge {gb.mergetime:.3f} s, '
+              f'speed-up bound {tserial / gb.mergetime:.1f}x), flow {gb.totcap:.4f}, {np.sum(msk != mskb)} voxels differ')
+
+def sweepLambda(shape=(32, 32, 8), lmbdas=np.linspace(0.05, 0.95, 19)):
+    # lmbda sweep vs one segment() per value; the masks must be identical
+    img, source, sink = graphCutPhantom(*shape)
+    g = graphCutBasic()
+    t = time.time()
+    breaks, masks = g.lambdaSweep(img, lmbdas, source=source, sink=sink)
+    print(f'sweep: {time.time() - t:.3f} s, {g.solves} solves for {len(lmbdas)} values, breakpoints {np.round(breaks, 3)}')
+    t = time.time()
+    differ = 0
+    for l, msk in zip(lmbdas, masks):
+        differ += np.sum(graphCutBasic().segment(img, source=source, sink=sink, lmbda=l) != msk)
+    print(f'one cut per value: {time.time() - t:.3f} s, {differ} voxels differ')
+
+def compareSupervoxels(shape=(128, 128, 32), supervoxels=(500, 2000), band=2):
+    # full cut vs supervoxel cuts refined in a band; as with the coarse-to-fine cut, differences outside the
+    # band are isolated specks of noise
+    img, source, sink = graphCutPhantom(*shape, noise=0.2)
+    t = time.time()
+    msk = graphCutBasic().segment(img, source=source, sink=sink, sigma=0.3)
+    print(f'full cut {time.time() - t:.3f} s, {np.prod(shape)} voxels, {np.sum(msk)} inside')
+    for n in supervoxels:
+        gs = graphCutBasic()
+        t = time.time()
+        msks = gs.segment(img, source=source, sink=sink, sigma=0.3, supervoxels=n, band=band)
+        inband = np.zeros(np.prod(shape), dtype=bool)
+        inband[gs.band] = True
+        inband = np.reshape(inband, shape, order='F')
+        print(f'supervoxels={n}: {time.time() - t:.3f} s (slic {gs.slictime:.3f} s), '
+              f'{np.max(gs.supervoxels) + 1} supervoxels, band {len(gs.band)} voxels, '
+              f'{np.sum((msk != msks) & inband)} differ in band, {np.sum((msk != msks) & ~inband)} outside')
+
+def graphMemory(shape=(128, 128, 32)):
+    # bytes per voxel of the graph storage (n-links and t-links) for the CSR graph and the implicit grid graph
+    img, source, sink = graphCutPhantom(*shape)
+    N = np.prod(shape)
+    for grid in (False, True):
+        g = graphCutBasic()
+        g.N = N
+        g.initEdges(img, np.full(N, 0.5), grid=grid)
+        if grid:
+            arrays = [g.capgrid, g.valid, g.tlinks]
+        else:
+            arrays = [g.indptr, g.indices, g.cap, g.rev, g.tlinks]
+        print(f'{"grid" if grid else "csr":5s}{sum(a.nbytes for a in arrays)/N:8.1f} bytes/voxel')
+
+def multiLabel(shape=(40, 40, 4), noise=0.8, method='expansion'):
+    # three labels (background and two boxes of different brightness) with alpha-expansion or alpha-beta swap
+    rng = np.random.default_rng(0)
+    img = rng.normal(0, noise, shape)
+    img[5:15, 5:15, :] += 1
+    img[22:35, 20:35, :] += 2
+    def block(x, y):
+        return np.ravel_multi_index(np.mgrid[x:x+3, y:y+3, 0:1].reshape(3, -1), shape, order='F')
+    gm = graphCutMulti()
+    labels = gm.segment(img, [block(0, 0), block(8, 8), block(26, 26)], sigma=0.5, lmbda=0.3, method=method)
+    print(f'initial energy {gm.energy[0]:.2f}')
+    for r in gm.report:
+        print(f'cycle {r["cycle"]} move {r["move"]}: {r["time"]:.3f} s energy {r["energy"]:.2f} '
+              f'changed {r["changed"]}')
+    print('label sizes', np.bincount(np.ravel(labels)))
+    return labels
+
+if __name__ == "__main__":
+    compareEngines()
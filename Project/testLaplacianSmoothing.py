@@ -0,0 +1,46 @@
+# % Convergence comparison of the laplacianSmoothing solvers
+# % ECE 8396: Medical Image Segmentation
+# % Spring 2025
+
+import numpy as np
+import matplotlib.pyplot as plt
+from laplacianSmoothing import *
+
+def smoothingProblem(r, c, d, seed=0):
+    # GVF-like test problem: a few Dirichlet nodes with large values, small data weights everywhere else
+    N = r*c*d
+    rng = np.random.default_rng(seed)
+    nodes = rng.permutation(N)
+    dirn = nodes[:N//500]
+    dirv = 5*rng.normal(size=len(dirn))
+    intn = nodes[N//500:]
+    intv = rng.normal(size=len(intn))
+    intw = 1e-3*rng.random(len(intn))
+    return dirn, dirv, intn, intv, intw
+
+def compareSolvers(sizes=((16,16,12), (32,30,24), (64,60,40)), directmax=30000):
+    # spsolve vs plain CG vs multigrid (stand-alone and as CG preconditioner) on growing volumes.
+    # Multigrid cycle counts should stay flat while CG iterations grow with the volume size.
+    # spsolve is only run up to directmax voxels
+    solvers = [('direct', None), ('cg', None), ('cg', 'jacobi'), ('multigrid', None), ('cg', 'multigrid')]
+
+    fig, ax = plt.subplots(1, len(sizes))
+    for i, (r, c, d) in enumerate(sizes):
+        dirn, dirv, intn, intv, intw = smoothingProblem(r, c, d)
+        print(f'{r}x{c}x{d} ({r*c*d} voxels)')
+        for solver, precond in solvers:
+            if solver == 'direct' and r*c*d > directmax:
+                continue
+            phi, info = laplacianSmoothing(r, c, d, dirn, dirv, intn, intv, intw, solver=solver, precond=precond,
+                                           tol=1e-8, return_info=True)
+            print(f'  {solver:10s}{str(precond):12s}{info["iterations"]:6d} iterations {info["time"]:8.3f} s '
+                  f'residual {info["residuals"][-1]:.1e}')
+            ax[i].semilogy(info['residuals'], label=f'{solver} {precond}')
+        ax[i].set_title(f'{r}x{c}x{d}')
+        ax[i].set_xlabel('Iteration')
+    ax[0].set_ylabel('Relative residual')
+    ax[0].legend()
+    plt.show()
+
+if __name__ == "__main__":
+    compareSolvers()